@@ -0,0 +1,36 @@
+import os, sys, random, timeit, copy
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'src', 'python'))
+
+from scallionDB.core.aggregation import pipeline, vectorized
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+GROUPS = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+REPEAT = 3
+
+GROUP = [{"$group": {"_id": {"k": "$k"}, "s": {"$sum": "$v"},
+                     "a": {"$avg": "$v"}, "m": {"$maximum": "$w"},
+                     "n": {"$sum": 1}}}]
+
+def rows(n):
+    return [{'_id': 'n%d' % i, 'k': 'g%d' % random.randrange(GROUPS),
+             'v': random.randint(0, 1000), 'w': random.random()}
+            for i in xrange(n)]
+
+def run(label, agg, result):
+    numpy = vectorized.numpy
+    timings = []
+    for backend in (None, numpy):
+        vectorized.numpy = backend
+        f = lambda: pipeline(copy.deepcopy(agg), result)
+        timings.append(timeit.timeit(f, number=REPEAT) / REPEAT)
+    vectorized.numpy = numpy
+    print "%-8s python %8.3f s   numpy %8.3f s" % (label, timings[0],
+          timings[1] if numpy is not None else float('nan'))
+
+if __name__ == '__main__':
+    if vectorized.numpy is None:
+        print "numpy is not importable, timing the python path only"
+    print "%d rows, %d groups" % (N, GROUPS)
+    result = rows(N)
+    run('$group', GROUP, result)
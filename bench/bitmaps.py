@@ -0,0 +1,40 @@
+import os, sys, random, timeit
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'src', 'python'))
+
+from scallionDB.core.bitmap import Bitmap
+from scallionDB.core.treeutil import generateID
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+REPEAT = 10
+
+def setsize(s):
+    return sys.getsizeof(s)
+
+def bitmapsize(b):
+    return sys.getsizeof(b.containers) + sum([sys.getsizeof(c) 
+                                              for c in b.containers.values()])
+
+def run(label, density):
+    ids = set()
+    while len(ids) < N:
+        ids.add(generateID())
+    ids = list(ids)
+    a = random.sample(xrange(N), int(N * density))
+    b = random.sample(xrange(N), int(N * density))
+    sa, sb = set([ids[i] for i in a]), set([ids[i] for i in b])
+    ba, bb = Bitmap(a), Bitmap(b)
+    assert len(sa & sb) == len(ba & bb) and len(sa | sb) == len(ba | bb)
+    for op, f, g in [('&', lambda: sa & sb, lambda: ba & bb),
+                     ('|', lambda: sa | sb, lambda: ba | bb)]:
+        old = timeit.timeit(f, number=REPEAT) / REPEAT
+        new = timeit.timeit(g, number=REPEAT) / REPEAT
+        print "%-12s %s  set %9.3f ms   bitmap %9.3f ms" % (
+            label, op, old * 1e3, new * 1e3)
+    print "%-12s    set %9.1f KB   bitmap %9.1f KB" % (
+        label, setsize(sa) / 1024., bitmapsize(ba) / 1024.)
+
+if __name__ == '__main__':
+    print "%d ids" % N
+    run('dense 50%', 0.5)
+    run('sparse 1%', 0.01)
@@ -0,0 +1,37 @@
+import os, sys, random
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'src', 'python'))
+
+from scallionDB.core.node import toNode
+from scallionDB.core.treeutil import flattenTree
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+FANOUT = 4
+
+def build(n):
+    nodes = [{'_id': 'n%d' % i, 'name': 'node%d' % (i % 1000),
+              'size': random.randint(0, 100), 'kind': random.choice('abc'),
+              '_children': []} for i in xrange(n)]
+    for i in xrange(1, n):
+        nodes[(i - 1) // FANOUT]['_children'].append(nodes[i])
+    return nodes[0]
+
+def dictsize(node):
+    return sys.getsizeof(node) + sys.getsizeof(node['_children'])
+
+def nodesize(node):
+    size = sys.getsizeof(node) + sys.getsizeof(node.data)
+    if node.children is not None:
+        size += sys.getsizeof(node.children)
+    return size
+
+if __name__ == '__main__':
+    print "%d nodes, fanout %d" % (N, FANOUT)
+    tree = build(N)
+    dicts = flattenTree(tree)
+    nodes = flattenTree(toNode(tree))
+    assert len(nodes) == len(dicts) == N
+    old = sum([dictsize(n) for n in dicts]) / float(N)
+    new = sum([nodesize(n) for n in nodes]) / float(N)
+    print "dict nodes  %7.1f bytes/node" % old
+    print "Node        %7.1f bytes/node" % new
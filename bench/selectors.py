@@ -0,0 +1,42 @@
+import os, sys, json, timeit
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'src', 'python'))
+
+from scallionDB.core.tree import Tree
+from scallionDB.core.treeutil import filterByRelation
+from scallionDB.core.bitmap import Bitmap
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+REPEAT = 20
+
+def build(n):
+    t = Tree('bench')
+    t.PUT('{}', 'SELF', {'_children': [{'v': i, 'w': i % 1000}
+                                       for i in xrange(n)]})
+    return t
+
+def scan(t, attr, value, operator):
+    ids = Bitmap()
+    ids.update(*[t.RI[attr][key] 
+                 for key in filterByRelation(t.RI[attr].keys(), value, operator)])
+    return ids
+
+def lookup(t, attr, value, operator):
+    return t.RI[attr].lookup(value, operator)
+
+def run(t, label, attr, value, operator):
+    assert scan(t, attr, value, operator) == lookup(t, attr, value, operator)
+    old = timeit.timeit(lambda: scan(t, attr, value, operator),
+                        number=REPEAT) / REPEAT
+    new = timeit.timeit(lambda: lookup(t, attr, value, operator),
+                        number=REPEAT) / REPEAT
+    print "%-28s scan %9.3f ms   lookup %9.3f ms   x%.0f" % (
+        label, old * 1e3, new * 1e3, old / max(new, 1e-9))
+
+if __name__ == '__main__':
+    t = build(N)
+    print "%d nodes, %d distinct values of v" % (N, len(t.RI['v']))
+    run(t, '{"v": 42}', 'v', 42, '$eq')
+    run(t, '{"v": {"$in": [1,2,3]}}', 'v', [1, 2, 3], '$in')
+    run(t, '{"v": {"$neq": 42}}', 'v', 42, '$neq')
+    run(t, '{"w": {"$neq": 42}}', 'w', 42, '$neq')
@@ -12,7 +12,8 @@
   limitations under the License.
  '''
  
-requests = ['GET','PUT','DELETE','LOAD','SHOW','DESCRIBE','SAVE']
+requests = ['GET','PUT','DELETE','LOAD','SHOW','DESCRIBE','SAVE','EXPLAIN',
+            'STATS','REGISTER','VIEW','UNREGISTER']
 resources = ['TREE','ATTR']
 references = ['ANCESTORS','PARENT','SELF','CHILDREN','DESCENDANTS']
 tree_references = ['SELF','PARENT']
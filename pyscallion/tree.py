@@ -84,6 +84,33 @@ class Tree(object):
                             
         return send_request(self.request, statement)		
         
+    def explain(self,selector):
+        selector = validateSelector(selector)
+
+        statement = ' '.join(["EXPLAIN",self.name,selector])
+        return send_request(self.request, statement)
+
+    def registerView(self,view,selector,reference,operations):
+        operations = validateAttrList(operations)
+        selector = validateSelector(selector)
+        reference = validateAttrReferences(reference)
+
+        statement = ' '.join(["REGISTER",self.name,view,reference.upper(),
+                              selector,operations])
+        return send_request(self.request, statement)
+
+    def view(self,view):
+        statement = ' '.join(["VIEW",self.name,view])
+        return send_request(self.request, statement)
+
+    def unregisterView(self,view):
+        statement = ' '.join(["UNREGISTER",self.name,view])
+        return send_request(self.request, statement)
+
+    def stats(self):
+        statement = ' '.join(["STATS",self.name])
+        return send_request(self.request, statement)
+
     def loadTree(self,path):
         statement = ' '.join(["LOAD",self.name,path])                        
         return send_request(self.request, statement)   
@@ -92,7 +119,10 @@ class Tree(object):
         statement = ' '.join(["SAVE", self.name])
         return send_request(self.request, statement)
     
-    def descTree(self):
-        raise Exception("Need to think about what this will do")
+    def descTree(self,selector={}):
+        selector = validateSelector(selector)
+
+        statement = ' '.join(["DESCRIBE",self.name,selector])
+        return send_request(self.request, statement)
 
         
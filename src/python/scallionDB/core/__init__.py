@@ -13,5 +13,5 @@
  '''
 
 from tree import Tree
-from resolver import evaluate
+from resolver import evaluate, resultKey
 from treeutil import treebreaker
\ No newline at end of file
@@ -12,4 +12,4 @@
   limitations under the License.
  '''
  
-from aggregate import pipeline
\ No newline at end of file
+from aggregate import pipeline, projection, stamped
\ No newline at end of file
@@ -14,22 +14,98 @@
  
 import operators
 import types
+
+from stream import collect
  
 aggFunc = {'$'+fn:operators.__dict__.get(fn) for fn in dir(operators) 
-               if isinstance(operators.__dict__.get(fn),types.FunctionType)}
+               if isinstance(operators.__dict__.get(fn),types.FunctionType)
+               and not fn.startswith('_')
+               and operators.__dict__.get(fn).__module__ == operators.__name__}
 
 aggFunc['$reduce'] = aggFunc.pop('$reduce_result')
 
 
 def pipeline(request,result):
-    for req in request:
+    """
+    Runs the stages over result, a list or Parts. Stages hand rows
+    on lazily where they can, the output is materialized at the end.
+    A $sort followed by a $limit keeps only the rows the limit takes.
+    """
+    for i, req in enumerate(request):
         if not isinstance(req,dict):
             raise SyntaxError("Invalid aggregation request")
         if len(req) > 1:
             raise SyntaxError("Only one operation allowed per iteration")
+        if req.keys()[0] == '$rollup':
+            raise SyntaxError("$rollup can only be the first stage")
         if req.keys()[0] not in aggFunc:
             raise SyntaxError("Only %s aggregation functions accepted" 
 			                 %str(aggFunc.keys()))
+        if req.keys()[0] == '$sort':
+            result = operators.sort(req.values()[0],result,
+                                    _limit(request[i+1:i+2]))
+            continue
         result = aggFunc[req.keys()[0]](req.values()[0],result)						 
-    return result
-	
\ No newline at end of file
+    return collect(result)
+
+def _limit(following):
+    """Row count a $sort can stop at when a $limit comes right after."""
+    if not following or not isinstance(following[0],dict):
+        return None
+    k = following[0].get('$limit')
+    if isinstance(k,int) and k >= 0 and len(following[0]) == 1:
+        return k
+    return None
+	
+def projection(request):
+    """
+    Attributes the stages read up to the first one that builds new
+    rows, or '*' when rows reach the output as they are. $group keys
+    rows by its aliases and names them after the fields, so both are
+    kept. Requests that do not parse get '*', and pipeline reports
+    their error.
+    """
+    fields = set()
+    try:
+        for req in request:
+            name, arg = req.items()[0]
+            if name in ('$reduce','$refreduce','$group'):
+                if name == '$group':
+                    arg = dict(arg)
+                    grouping = arg.pop('_id')
+                    fields.update(grouping.keys())
+                    fields.update([v[1:] for v in grouping.values()])
+                fields.update([operand for okey, op, operand 
+                               in operators._operands(arg) if op != '$sum1'])
+                return sorted(fields)
+            if name in ('$unwind','$bucket'):
+                fields.update(arg)
+            elif name == '$sort':
+                fields.update([d.keys()[0] for d in arg])
+            elif name == '$match':
+                fields.update(_matchFields(arg))
+            elif name not in ('$limit','$flatten'):
+                return '*'
+    except Exception:
+        return '*'
+    return '*'
+
+def stamped(request):
+    """
+    Attributes $bucket stages read. The tree hands them over in seconds
+    since the epoch rather than as they were written.
+    """
+    stamps = set()
+    for req in request:
+        if isinstance(req,dict) and isinstance(req.get('$bucket'),dict):
+            stamps.update(req['$bucket'])
+    return sorted(stamps)
+
+def _matchFields(request):
+    for k, v in request.iteritems():
+        if k in ('$and','$or'):
+            for d in v:
+                for field in _matchFields(d):
+                    yield field
+        else:
+            yield k
@@ -13,6 +13,13 @@
  '''
  
  
+import heapq
+import random
+
+from hashlib import md5
+from math import ceil, log, sqrt
+from struct import unpack_from
+
 def add(iplist):
     if isinstance(iplist,list):
         return sum([i for i in iplist if i is not None])
@@ -73,6 +80,35 @@ def avg1(iplist):
     else:
         return 0
 		
+def approxDistinct(iplist):
+    if isinstance(iplist,list):
+        return _sketch(ApproxDistinct(),iplist)
+    else:
+        return 0
+
+def approxQuantile(iplist,q=0.5):
+    if isinstance(iplist,list):
+        return _sketch(ApproxQuantile(q),iplist)
+    else:
+        return None
+
+def median(iplist):
+    if isinstance(iplist,list):
+        return _sketch(Median(),iplist)
+    else:
+        return None
+
+def percentile(iplist,p=50):
+    if isinstance(iplist,list):
+        return _sketch(Percentile(p),iplist)
+    else:
+        return None
+
+def _sketch(acc,iplist):
+    for i in iplist:
+        acc.update(i)
+    return acc.result()
+
 def minimum(iplist):
     if  iplist and isinstance(iplist,list):
         return min(iplist)
@@ -86,3 +122,553 @@ def maximum(iplist):
         return None
 		
 
+
+def _number(value, integral):
+    if integral:
+        return int(value)
+    return value
+
+# sum, sum1, count, avg, avg1, minimum and maximum over a gathered
+# column: values holds the numbers in result order, size counts the
+# results including those without a number, integral tells whether
+# all the numbers were ints.
+columnar = {
+    '$sum': lambda values, size, integral: 
+                _number(sum(values), integral),
+    '$sum1': lambda values, size, integral: size,
+    '$count': lambda values, size, integral: len(values),
+    '$avg': lambda values, size, integral: 
+                sum(values)/(1.0*size) if size else 0,
+    '$avg1': lambda values, size, integral:
+                 sum(values)/(1.0*len(values)) if values else 0,
+    '$minimum': lambda values, size, integral:
+                    _number(min(values), integral)
+                    if values and len(values) == size else None,
+    '$maximum': lambda values, size, integral:
+                    _number(max(values), integral) if values else None,
+}
+
+
+class Total(object):
+    """
+    Running form of the functions above for single pass grouping:
+    update is called with every value in result order and result
+    returns what the function returns on the whole list. remove takes
+    a value back out and returns False when that cannot be done
+    exactly, the accumulator then has to be rebuilt.
+    """
+    __slots__ = ('rows', 'values', 'total')
+
+    def __init__(self):
+        self.rows = self.values = self.total = 0
+
+    def combine(self, other):
+        """Takes in an accumulator fed with the rows after ours."""
+        self.rows += other.rows
+        self.values += other.values
+        self.total = self.total + other.total
+
+    def exact(self, value):
+        """Whether value can be taken back out of the total exactly."""
+        return not isinstance(value, float) and \
+            not isinstance(self.total, float)
+
+class Sum(Total):
+    __slots__ = ()
+    def update(self, value):
+        if value is not None:
+            self.total = self.total + value
+    def remove(self, value):
+        if value is not None:
+            if not self.exact(value):
+                return False
+            self.total = self.total - value
+        return True
+    def result(self):
+        return self.total
+
+class Sum1(Total):
+    __slots__ = ()
+    def update(self, value):
+        self.rows += 1
+    def remove(self, value):
+        self.rows -= 1
+        return True
+    def result(self):
+        return self.rows
+
+class Count(Total):
+    __slots__ = ()
+    def update(self, value):
+        if value is not None:
+            self.values += 1
+    def remove(self, value):
+        if value is not None:
+            self.values -= 1
+        return True
+    def result(self):
+        return self.values
+
+class Avg(Total):
+    __slots__ = ()
+    def update(self, value):
+        self.rows += 1
+        if value is not None:
+            self.total = self.total + value
+    def remove(self, value):
+        if value is not None:
+            if not self.exact(value):
+                return False
+            self.total = self.total - value
+        self.rows -= 1
+        return True
+    def result(self):
+        return self.total/(1.0*self.rows) if self.rows else 0
+
+class Avg1(Total):
+    __slots__ = ()
+    def update(self, value):
+        if value is not None:
+            self.values += 1
+            self.total = self.total + value
+    def remove(self, value):
+        if value is not None:
+            if not self.exact(value):
+                return False
+            self.values -= 1
+            self.total = self.total - value
+        return True
+    def result(self):
+        return self.total/(1.0*self.values) if self.values else 0
+
+class Extreme(object):
+    __slots__ = ('value', 'empty')
+
+    def __init__(self):
+        self.value = None
+        self.empty = True
+
+    def combine(self, other):
+        if not other.empty:
+            self.update(other.value)
+
+    def result(self):
+        return self.value
+
+class Minimum(Extreme):
+    __slots__ = ()
+    def update(self, value):
+        if self.empty:
+            self.value, self.empty = value, False
+        elif value < self.value:
+            self.value = value
+
+class Maximum(Extreme):
+    __slots__ = ()
+    def update(self, value):
+        if self.empty:
+            self.value, self.empty = value, False
+        elif value > self.value:
+            self.value = value
+
+class Distinct(object):
+    __slots__ = ('values',)
+
+    def __init__(self):
+        self.values = set()
+
+    def update(self, value):
+        if value is not None:
+            self.values.add(value)
+
+    def combine(self, other):
+        self.values.update(other.values)
+
+class Unique(Distinct):
+    __slots__ = ()
+    def result(self):
+        return list(self.values)
+
+class LenUnique(Distinct):
+    __slots__ = ()
+    def result(self):
+        return len(self.values)
+
+class Lists(object):
+    """Accumulators of list values, None as soon as a value is not a
+    list. A single list is returned as it is, like reduce does."""
+    __slots__ = ('rows', 'first', 'merged')
+
+    def __init__(self):
+        self.rows = 0
+        self.first = self.merged = None
+
+    def update(self, value):
+        if self.rows < 0:
+            return
+        if not isinstance(value, list):
+            self.rows = -1
+            self.first = self.merged = None
+            return
+        self.rows += 1
+        if self.rows == 1:
+            self.first = value
+        elif self.rows == 2:
+            self.merged = self.start(self.first, value)
+            self.first = None
+        else:
+            self.merge(value)
+
+    def combine(self, other):
+        if self.rows < 0 or other.rows == 0:
+            return
+        if other.rows < 0 or self.rows == 0:
+            self.rows, self.first, self.merged = (other.rows, other.first,
+                                                  other.merged)
+            return
+        theirs = other.first if other.rows == 1 else other.merged
+        if self.rows == 1:
+            self.merged = self.start(self.first, theirs)
+            self.first = None
+        else:
+            self.merge(theirs)
+        self.rows += other.rows
+
+    def result(self):
+        if self.rows < 0:
+            return None
+        if self.rows == 1:
+            return self.single(self.first)
+        return self.finish()
+
+class Append(Lists):
+    __slots__ = ()
+    def start(self, first, value):
+        return first + value
+    def merge(self, value):
+        self.merged.extend(value)
+    def single(self, first):
+        return first
+    def finish(self):
+        return self.merged
+
+class Union(Lists):
+    __slots__ = ()
+    def start(self, first, value):
+        return set.union(set(first), set(value))
+    def merge(self, value):
+        self.merged.update(value)
+    def single(self, first):
+        return list(first)
+    def finish(self):
+        return list(self.merged)
+
+class Intersection(Lists):
+    __slots__ = ()
+    def start(self, first, value):
+        return set.intersection(set(first), set(value))
+    def merge(self, value):
+        self.merged.intersection_update(value)
+    def single(self, first):
+        return list(first)
+    def finish(self):
+        return list(self.merged)
+
+HLL_PRECISION = 12
+HLL_EXACT = 256
+
+def _hash(value):
+    """64 bit hash of value, the same in every process."""
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return unpack_from('<Q', md5(repr(value)).digest())[0]
+
+class ApproxDistinct(object):
+    """
+    HyperLogLog count of the distinct values other than None. Up to
+    HLL_EXACT distinct hashes are kept as they are and counted
+    exactly, past that they go into 2**HLL_PRECISION registers of one
+    byte. Counts are estimated from the register histogram with the
+    improved estimator of Ertl, which needs no bias tables, and are
+    within about 1.6%.
+    """
+    __slots__ = ('hashes', 'registers')
+
+    def __init__(self):
+        self.hashes = set()
+        self.registers = None
+
+    def update(self, value):
+        if value is None:
+            return
+        if self.registers is None:
+            self.hashes.add(_hash(value))
+            if len(self.hashes) > HLL_EXACT:
+                self._dense()
+        else:
+            self._add(_hash(value))
+
+    def _add(self, x):
+        bits = 64 - HLL_PRECISION
+        low = x & ((1 << bits) - 1)
+        rank = bits - low.bit_length() + 1
+        if rank > self.registers[x >> bits]:
+            self.registers[x >> bits] = rank
+
+    def _dense(self):
+        self.registers = bytearray(1 << HLL_PRECISION)
+        for x in self.hashes:
+            self._add(x)
+        self.hashes = None
+
+    def combine(self, other):
+        if other.registers is None:
+            if self.registers is None:
+                self.hashes.update(other.hashes)
+                if len(self.hashes) > HLL_EXACT:
+                    self._dense()
+            else:
+                for x in other.hashes:
+                    self._add(x)
+            return
+        if self.registers is None:
+            self._dense()
+        self.registers = bytearray(map(max, self.registers, 
+                                       other.registers))
+
+    def result(self):
+        if self.registers is None:
+            return len(self.hashes)
+        m = float(len(self.registers))
+        top = 64 - HLL_PRECISION + 1
+        counts = [self.registers.count(chr(k)) for k in range(top + 1)]
+        z = m * _tau(1 - counts[top] / m)
+        for k in range(top - 1, 0, -1):
+            z = 0.5 * (z + counts[k])
+        z += m * _sigma(counts[0] / m)
+        return int(round(m * m / (2 * log(2)) / z))
+
+def _sigma(x):
+    if x == 1:
+        return float('inf')
+    y, z = 1.0, x
+    while True:
+        x *= x
+        previous, z = z, z + x * y
+        y += y
+        if z == previous:
+            return z
+
+def _tau(x):
+    if x == 0 or x == 1:
+        return 0.0
+    y, z = 1.0, 1 - x
+    while True:
+        x = sqrt(x)
+        y *= 0.5
+        previous, z = z, z - (1 - x) ** 2 * y
+        if z == previous:
+            return z / 3
+
+KLL_SIZE = 200
+KLL_RATIO = 2 / 3.0
+
+class ApproxQuantile(object):
+    """
+    KLL sketch of the values other than None, giving the value of rank
+    q in their order, q = 0.5 by default. Levels hold values standing
+    for 2**level values each. A full level is sorted and every other
+    value moves up one level, levels below the top keeping a fraction
+    of KLL_SIZE, so a sketch stays under 3*KLL_SIZE values. Ranks are
+    exact until the first compaction and within about 1% after.
+    """
+    __slots__ = ('q', 'levels', 'size', 'capacity', 'flip')
+    arguments = ()
+
+    def __init__(self, q=None):
+        if q is None:
+            q = self.arguments[0] if self.arguments else 0.5
+        if isinstance(q, bool) or not isinstance(q, (int, long, float)) \
+                or not 0 <= q <= 1:
+            raise ValueError("quantile should be a number from 0 to 1")
+        self.q = q
+        self.levels = [[]]
+        self.size = 0
+        self.capacity = self._capacity(0)
+        self.flip = 0
+
+    def __reduce__(self):
+        return (ApproxQuantile, (self.q,), 
+                (self.levels, self.size, self.capacity, self.flip))
+
+    def __setstate__(self, state):
+        self.levels, self.size, self.capacity, self.flip = state
+
+    def _capacity(self, level):
+        height = len(self.levels)
+        return int(ceil(KLL_SIZE * KLL_RATIO ** (height - level - 1))) + 1
+
+    def _grow(self):
+        self.levels.append([])
+        self.capacity = sum([self._capacity(h) 
+                             for h in range(len(self.levels))])
+
+    def update(self, value):
+        if value is None:
+            return
+        self.levels[0].append(value)
+        self.size += 1
+        if self.size >= self.capacity:
+            self._compress()
+
+    def _compress(self):
+        while self.size >= self.capacity:
+            for h, level in enumerate(self.levels):
+                if len(level) >= self._capacity(h):
+                    break
+            if h + 1 == len(self.levels):
+                self._grow()
+            level.sort()
+            kept = [level.pop()] if len(level) % 2 else []
+            self.levels[h + 1].extend(level[self.flip::2])
+            self.flip ^= 1
+            self.size -= len(level) - len(level) // 2
+            self.levels[h] = kept
+
+    def combine(self, other):
+        while len(self.levels) < len(other.levels):
+            self._grow()
+        for level, values in zip(self.levels, other.levels):
+            level.extend(values)
+        self.size += other.size
+        self._compress()
+
+    def result(self):
+        weighted = sorted([(v, 1 << h) for h, level in enumerate(self.levels)
+                           for v in level])
+        if not weighted:
+            return None
+        rank = self.q * sum([w for v, w in weighted])
+        seen = 0
+        for v, w in weighted:
+            seen += w
+            if seen >= rank:
+                return v
+        return weighted[-1][0]
+
+
+def _select(values, k):
+    """
+    k-th smallest of values, 0 based, in expected linear time. Ranks
+    near either end go through a heap, others through quickselect
+    with random pivots.
+    """
+    n = len(values)
+    if k < n >> 6:
+        return heapq.nsmallest(k + 1, values)[-1]
+    if n - k <= n >> 6:
+        return heapq.nlargest(n - k, values)[-1]
+    while len(values) > 64:
+        pivot = values[random.randrange(len(values))]
+        lower = [v for v in values if v < pivot]
+        if k < len(lower):
+            values = lower
+            continue
+        upper = [v for v in values if v > pivot]
+        if k < len(values) - len(upper):
+            return pivot
+        k -= len(values) - len(upper)
+        values = upper
+    return sorted(values)[k]
+
+def _rank(p, n):
+    """0 based position of the nearest rank p-th percentile of n values."""
+    return max(int(ceil(p * n / 100.0)), 1) - 1
+
+def _middle(lower, upper):
+    """Median of an even number of values from the two middle ones."""
+    if all([isinstance(v, (int, long, float)) and not isinstance(v, bool)
+            for v in (lower, upper)]):
+        return (lower + upper) / 2.0
+    return lower
+
+class Selection(object):
+    """
+    Values other than None, kept whole so that result picks the order
+    statistic out exactly with _select.
+    """
+    __slots__ = ('values',)
+
+    def __init__(self):
+        self.values = []
+
+    def update(self, value):
+        if value is not None:
+            self.values.append(value)
+
+    def combine(self, other):
+        self.values.extend(other.values)
+
+class Median(Selection):
+    """The middle value, the mean of the two middle numbers when
+    there is an even count of them."""
+    __slots__ = ()
+    def result(self):
+        n = len(self.values)
+        if not n:
+            return None
+        lower = _select(self.values, (n - 1) // 2)
+        if n % 2:
+            return lower
+        return _middle(lower, _select(self.values, n // 2))
+
+class Percentile(Selection):
+    """Nearest rank percentile, p from 0 to 100 and 50 by default."""
+    __slots__ = ('p',)
+    arguments = ()
+
+    def __init__(self, p=None):
+        Selection.__init__(self)
+        if p is None:
+            p = self.arguments[0] if self.arguments else 50
+        if isinstance(p, bool) or not isinstance(p, (int, long, float)) \
+                or not 0 <= p <= 100:
+            raise ValueError("percentile should be a number from 0 to 100")
+        self.p = p
+
+    def __reduce__(self):
+        return (Percentile, (self.p,), self.values)
+
+    def __setstate__(self, values):
+        self.values = values
+
+    def result(self):
+        if not self.values:
+            return None
+        return _select(self.values, _rank(self.p, len(self.values)))
+
+
+class Accumulators(dict):
+    """
+    Accumulator classes by operator. An operator given as a tuple of
+    its name and arguments gets a subclass with the arguments bound.
+    """
+    def __missing__(self, op):
+        if not isinstance(op, tuple):
+            raise KeyError(op)
+        base = self[op[0]]
+        bound = self[op] = type(base.__name__, (base,), 
+                                {'__slots__': (), 'arguments': op[1:]})
+        return bound
+
+accumulators = {'$sum': Sum, '$sum1': Sum1, '$count': Count, '$avg': Avg,
+                '$avg1': Avg1, '$minimum': Minimum, '$maximum': Maximum,
+                '$unique': Unique, '$lenunique': LenUnique, 
+                '$append': Append, '$union': Union, 
+                '$intersection': Intersection, 
+                '$approxDistinct': ApproxDistinct, 
+                '$approxQuantile': ApproxQuantile,
+                '$median': Median, '$percentile': Percentile}
+accumulators = Accumulators(accumulators)
@@ -14,33 +14,66 @@
  
 import types
 import itertools
+import heapq
 
 from collections import defaultdict
-from operator import itemgetter
+from datetime import datetime, timedelta
+
+from scallionDB.parser.constants import relational
+from scallionDB.core.treeutil import matchRelation
+from scallionDB.core.columns import epoch
+from scallionDB.core.dateutil.relativedelta import relativedelta
 
 import apply
+import vectorized
+from stream import nested
  
 applyFunc = {'$'+fn:apply.__dict__.get(fn) for fn in dir(apply) 
-               if isinstance(apply.__dict__.get(fn),types.FunctionType)}
+               if isinstance(apply.__dict__.get(fn),types.FunctionType)
+               and not fn.startswith('_')}
 
 applyFunc['$sum'] = applyFunc.pop('$add')
 
+BUCKET_UNITS = {'minute':{'minutes':1}, 'hour':{'hours':1}, 'day':{'days':1},
+                'week':{'weeks':1}, 'month':{'months':1}}
+BUCKET_STEPS = ['years','months','weeks','days','hours','minutes','seconds']
+EPOCH = datetime(1970,1,1)
+MONDAY = 4*86400
+
 
 def flatten(request,result):
     if not request:
         raise SyntaxError ("Always be truthful to flatten")
-    if isinstance(result[0],list):
-        return sum(result,[])
-    else:
-        return result
+    parts = nested(result)
+    if parts is not None:
+        return parts.rows()
+    return result
 
 def reduce_result(request,result):
     """
     {"foo":{"$sum":"$foo"}}	
 	"""
-    result = flatten(True,result)
-    red = defaultdict(lambda: defaultdict(list))
-    output = {}
+    operands = _operands(request)
+    accs = [apply.accumulators[op]() for okey, op, operand in operands]
+    update = [(acc.update,operand) for acc, (okey, op, operand) 
+              in zip(accs,operands)]
+    empty = True
+    for res in flatten(True,result):
+        empty = False
+        for fn, field in update:
+            fn(res.get(field))
+    if empty:
+        return {}
+    return dict([(operands[i][0],accs[i].result()) 
+                 for i in _order(operands)])
+
+def _operands(request):
+    """
+    (alias, operator, attribute) triples of a $reduce request. An
+    operand given as a list is the attribute followed by arguments of
+    the operator, which is then a tuple of its name and arguments.
+    """
+    operands = []
     for okey, req in request.items():
         if okey.startswith('$'):
             raise SyntaxError("Aliases cannot start with $")	
@@ -50,6 +83,15 @@ def reduce_result(request,result):
         if operator not in applyFunc.keys():
             raise SyntaxError("apply function should be one of %s"
 			                   %str(applyFunc.keys()))  
+        if isinstance(operand, list) and operand:
+            operand, args = operand[0], tuple(operand[1:])
+            try:
+                apply.accumulators[operator](*args)
+            except (TypeError, ValueError), e:
+                raise SyntaxError("Invalid arguments %s for %s: %s"
+                                  %(str(list(args)),operator,str(e)))
+            if args:
+                operator = (operator,) + args
         if isinstance(operand, basestring):
             if not operand.startswith('$'):
                 raise SyntaxError("Variable %s should be prefixed with '$'"
@@ -60,25 +102,47 @@ def reduce_result(request,result):
         else:
             raise SyntaxError("Variable should start '$' or set to 1"
 			                      " if operator is '$sum' (for group counts)")    			
-        for res in result:
-            red[operator][okey].append(res.get(operand,None))
-			
+        operands.append((okey,operator,operand))
+    return operands
+
+def _vectorReduce(operands,result,codes,count):
+    """
+    One output dict per group code, filled by numpy, or None when an
+    operand has to go through the Python operators.
+    """
+    grouped = vectorized.Groups(codes,count)
+    columns = {}
+    red = defaultdict(dict)
+    for okey, operator, operand in operands:
+        if operand not in columns:
+            columns[operand] = [res.get(operand) for res in result]
+        values = grouped.reduce(operator,columns[operand])
+        if values is None:
+            return None
+        red[operator][okey] = values
+    outputs = [{} for i in xrange(count)]
     for operator, groups in red.iteritems():
-        for okey, l in groups.iteritems():
-            output[okey] = applyFunc[operator](l)	
-    return output
+        for okey, values in groups.iteritems():
+            for output, value in zip(outputs,values):
+                output[okey] = value
+    return outputs
    
 
 def refreduce(request,result):
-    if not isinstance(result[0],list):
+    parts = nested(result)
+    if parts is None:
         raise ValueError("Cannot reference reduce on a flat tree")
-    return [reduce_result(request, res) for res in result]
+    _operands(request)
+    return (reduce_result(request, res) for res in parts)
 
 
 def unwind(request,result):
-    if result and isinstance(result[0],list):
-        return [unwind(request,res) for res in result]
-    unwinded = []
+    parts = nested(result)
+    if parts is not None:
+        return parts.map(lambda part: unwind(request,part))
+    return _unwind(request,result)
+
+def _unwind(request,result):
     for res in result:
         unwMap = {}
         for l in request:
@@ -95,19 +159,141 @@ def unwind(request,result):
             for k,v in res.iteritems():
                 if not k in request:
                     unwMap[k] = v
-            unwinded.append(unwMap)         
-    return unwinded
+            yield unwMap
+
+def bucket(request,result):
+    """
+    {"_ts_at":"hour","_ts_to":{"months":3}}
+    Replaces timestamps, seconds since the epoch or ISO strings as the
+    tree indexes them, by the UTC start of their bucket as an ISO
+    string. Fixed steps count from the epoch, or from a Monday when they
+    are whole weeks. Steps of months and years follow the calendar.
+    """
+    if not isinstance(request,dict) or not request:
+        raise SyntaxError("$bucket needs timestamp attributes and their steps")
+    starts = [(k,_bucketer(step)) for k, step in request.iteritems()]
+    def assign(res):
+        res = dict(res)
+        for k, start in starts:
+            value = res.get(k)
+            if value is None:
+                continue
+            if isinstance(value,basestring):
+                value = epoch(value)
+            elif isinstance(value,bool) or \
+                    not isinstance(value,(int,long,float)):
+                raise ValueError("Can only bucket timestamps. Not %s in %s"
+                                 %(k,str(res)))
+            res[k] = start(value)
+        return res
+    parts = nested(result)
+    if parts is not None:
+        return parts.map(lambda part: itertools.imap(assign,part))
+    return itertools.imap(assign,result)
+
+def _bucketer(step):
+    """Function giving the ISO start of the bucket of an epoch time."""
+    if isinstance(step,basestring) and step in BUCKET_UNITS:
+        step = BUCKET_UNITS[step]
+    if not isinstance(step,dict) or not step or \
+            not all([k in BUCKET_STEPS and isinstance(v,(int,long)) 
+                     and not isinstance(v,bool) and v > 0 
+                     for k, v in step.iteritems()]):
+        raise SyntaxError("$bucket step should be one of %s or positive "
+                          "counts of %s" %(sorted(BUCKET_UNITS),BUCKET_STEPS))
+    delta = relativedelta(**step)
+    months = delta.years*12 + delta.months
+    seconds = ((delta.days*24 + delta.hours)*60 + delta.minutes)*60 + \
+              delta.seconds
+    if months and seconds:
+        raise SyntaxError("$bucket step cannot mix months with shorter units")
+    starts = {}
+    if months:
+        def start(value):
+            at = EPOCH + timedelta(seconds=value)
+            key = ((at.year - 1970)*12 + at.month - 1) // months * months
+            if key not in starts:
+                starts[key] = (EPOCH + relativedelta(months=key)).isoformat()
+            return starts[key]
+        return start
+    origin = MONDAY if seconds % (7*86400) == 0 else 0
+    def start(value):
+        key = (value - origin) // seconds * seconds + origin
+        if key not in starts:
+            starts[key] = (EPOCH + timedelta(seconds=key)).isoformat()
+        return starts[key]
+    return start
+
+def match(request,result):
+    """
+    {"a":{"$gt":1},"b":"foo"}
+    """
+    test = _predicate(request)
+    parts = nested(result)
+    if parts is not None:
+        return parts.map(lambda part: itertools.ifilter(test,part))
+    return itertools.ifilter(test,result)
+
+def _predicate(request):
+    """
+    Row test for a $match request. Conditions are written as in
+    selectors and ANDed, rows missing an attribute only pass $exists
+    false, and list values compare as the index stores them.
+    """
+    if not isinstance(request,dict):
+        raise SyntaxError("Match request should be of dict type")
+    tests = []
+    for k, v in request.iteritems():
+        if k in ('$and','$or'):
+            if not isinstance(v,list) or not v:
+                raise SyntaxError("%s needs a non empty list of conditions" %k)
+            subs = [_predicate(d) for d in v]
+            join = all if k == '$and' else any
+            tests.append(lambda res, subs=subs, join=join: 
+                         join(t(res) for t in subs))
+            continue
+        if k.startswith('$'):
+            raise SyntaxError("Match keys should not start with $ "
+                              "other than $and, $or")
+        if isinstance(v,dict):
+            if len(v) != 1:
+                raise SyntaxError("Each match condition should be of length 1")
+            operator, value = v.items()[0]
+        else:
+            operator, value = '$eq', v
+        if operator not in relational:
+            raise SyntaxError("Comparison should be made with one of %s" 
+                              %str(relational))
+        if operator == '$exists':
+            tests.append(lambda res, k=k, value=bool(value): 
+                         (k in res) == value)
+        else:
+            tests.append(lambda res, k=k, value=value, operator=operator: 
+                         k in res and 
+                         matchRelation(_key(res[k]),value,operator))
+    return lambda res: all(t(res) for t in tests)
+
+def _key(value):
+    if isinstance(value,list):
+        return tuple([a for a in value if not isinstance(a,(list,dict))])
+    return value
  
 def group(request,result):
     """
 	{"_id":{"":""},"a":{"$sum":"$a"}}
 	"""
-    if result and isinstance(result[0],list):
-        return [group(request,res) for res in result]
+    request, grouping = _grouping(request)
+    _operands(request)
+    parts = nested(result)
+    if parts is not None:
+        return parts.map(lambda part: _group(request,grouping,part))
+    return _group(request,grouping,result)
 
-    aggregate = defaultdict(list)
+def _grouping(request):
+    """The reductions of a $group request and its alias to key map."""
     if not request.has_key('_id'):
         raise SyntaxError("No grouping keys provided")
+    request = dict(request)
     g = request.pop('_id')
     if not isinstance(g, dict):
         raise SyntaxError("Grouping should be of dict type") 
@@ -120,29 +306,97 @@ def group(request,result):
         if k.startswith('$'):
             raise SyntaxError("Aliases cannot start with $")		
         grouping[k] = v[1:]	
+    return request, grouping
+
+def _group(request,grouping,result):
+    """
+    Groups the rows of one part. Rows are consumed one at a time,
+    unless numpy can take them, which needs them all in a list.
+    """
+    operators = [req.keys()[0] for req in request.values()
+                 if isinstance(req,dict) and req]
+    if vectorized.usable(operators):
+        if not isinstance(result,list):
+            result = list(result)
+        if vectorized.usable(operators,result):
+            output = _vectorGroup(request,grouping,result)
+            if output is not None:
+                return output
+    operands = _operands(request)
+    accumulators = [apply.accumulators[op] for okey, op, operand in operands]
+    fields = [operand for okey, op, operand in operands]
+    names = grouping.keys()
+    aggregate = {}
+    updates = {}
     for res in result:
-        key = tuple([res.get(k) for k in grouping.keys()])
-        aggregate[key].append(res)
+        if len(names) == 1:
+            key = (res.get(names[0]),)
+        else:
+            key = tuple([res.get(k) for k in names])
+        update = updates.get(key)
+        if update is None:
+            accs = aggregate[key] = [acc() for acc in accumulators]
+            update = updates[key] = [(acc.update,field) 
+                                     for acc, field in zip(accs,fields)]
+        for fn, field in update:
+            fn(res.get(field))
+    order = _order(operands)
     output = []
-    for k,v in aggregate.items():
+    for k,accs in aggregate.items():
         ret = {}
         for gk, gv in zip(grouping.values(),k):
             ret[gk] = gv
-        red = reduce_result(request,v)
+        red = {}
+        for i in order:
+            red[operands[i][0]] = accs[i].result()
         ret.update(red)
         output.append(ret)
     return output
 
+def _order(operands):
+    """
+    Positions of the operands in the order reduce_result fills its
+    output, so single pass groups come out with the same key order.
+    """
+    red = defaultdict(dict)
+    for i, (okey, operator, operand) in enumerate(operands):
+        red[operator][okey] = i
+    return [i for groups in red.itervalues() for i in groups.itervalues()]
+
+def _vectorGroup(request,grouping,result):
+    keys = {}
+    rowKeys = zip(*[[res.get(k) for res in result] for k in grouping.keys()])
+    if not grouping:
+        rowKeys = [()]*len(result)
+    codes = [keys.setdefault(key,len(keys)) for key in rowKeys]
+    outputs = _vectorReduce(_operands(request),result,codes,len(keys))
+    if outputs is None:
+        return None
+    output = []
+    for k,code in keys.items():
+        ret = {}
+        for gk, gv in zip(grouping.values(),k):
+            ret[gk] = gv
+        ret.update(outputs[code])
+        output.append(ret)
+    return output
+
 def limit(request,result):
     if not isinstance(request,int):
         raise SyntaxError("Limit number should be integer")
-    if result and isinstance(result[0],list):
-        return [limit(request,res) for res in result]
-    return result[:request]
+    parts = nested(result)
+    if parts is not None:
+        return parts.map(lambda part: limit(request,part))
+    if request < 0:
+        return list(result)[:request]
+    return itertools.islice(result,request)
 		
-def sort(request,result):
-    if result and isinstance(result[0],list):
-        return [sort(request,res) for res in result] 
+def sort(request,result,limit=None):
+    """
+    [{"a":1},{"b":-1}]
+    Rows missing a key sort as if it were None. With limit, only the
+    first limit rows are kept, through a heap.
+    """
     if not isinstance(request,list):
         raise SyntaxError("Sort request should be a list of sorting key/value pairs")
     if not all([isinstance(d,dict) for d in request]):
@@ -159,17 +413,69 @@ def sort(request,result):
     for v in sortOrder:
         if v != 1 and v != -1:
             raise SyntaxError("Sort values should be 1 or -1 ")	 			
-    for res in result:
-        for k in sortKeys:
-            if not res.has_key(k):
-                res[k] = None
-	
-    comparers = [(itemgetter(k),v) for k,v in zip(sortKeys,sortOrder)]
-    def comparer(left,right):
-        for fn, mult in comparers:
-            result = cmp(fn(left),fn(right))
-            if result:
-                return mult * result
+    parts = nested(result)
+    if parts is not None:
+        return parts.map(lambda part: sort(request,part,limit))
+    if not sortKeys:
+        result = list(result)
+        return result if limit is None else result[:limit]
+    if limit is not None:
+        return _topk(zip(sortKeys,sortOrder),limit,result)
+    result = list(result)
+    for keys, order in reversed(_runs(zip(sortKeys,sortOrder))):
+        result.sort(key=_getter(keys),reverse=order == -1)
+    return result
+
+def _runs(keyOrders):
+    """Consecutive sort keys of the same direction, grouped."""
+    runs = []
+    for k, v in keyOrders:
+        if runs and runs[-1][1] == v:
+            runs[-1][0].append(k)
         else:
-            return 0
-    return sorted(result,cmp=comparer)
\ No newline at end of file
+            runs.append(([k],v))
+    return runs
+
+def _getter(keys):
+    if len(keys) == 1:
+        key = keys[0]
+        return lambda res: res.get(key)
+    return lambda res: tuple([res.get(k) for k in keys])
+
+def _topk(keyOrders,k,result):
+    runs = _runs(keyOrders)
+    if len(runs) == 1:
+        keys, order = runs[0]
+        select = heapq.nsmallest if order == 1 else heapq.nlargest
+        return select(k,result,key=_getter(keys))
+    def key(res):
+        return tuple([res.get(k) if v == 1 else _Descending(res.get(k)) 
+                      for k, v in keyOrders])
+    return heapq.nsmallest(k,result,key=key)
+
+
+class _Descending(object):
+    """Sort key wrapper that inverts the order of the value it holds."""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __le__(self, other):
+        return other.value <= self.value
+
+    def __gt__(self, other):
+        return other.value > self.value
+
+    def __ge__(self, other):
+        return other.value >= self.value
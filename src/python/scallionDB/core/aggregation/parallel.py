@@ -0,0 +1,157 @@
+''' 
+  Licensed under the Apache License, Version 2.0 (the "License"); you may
+  not use this file except in compliance with the License. You may obtain
+  a copy of the License at
+ 
+      http://www.apache.org/licenses/LICENSE-2.0
+ 
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+ '''
+
+import multiprocessing
+
+from collections import deque
+from itertools import islice, chain
+
+import apply
+from operators import _operands, _grouping, _order
+
+PROCESSES = 1
+PARALLEL_ROWS = 200000
+PARTITION_ROWS = 50000
+
+_pool = None
+
+
+class Plan(object):
+    """
+    A pipeline starting with a $reduce, or a $flatten and a $group,
+    whose reductions can be computed on partitions of the rows and
+    combined. Rows are tuples of the group keys, then the operands.
+    """
+
+    def __init__(self, request, grouping, rest):
+        self.operands = _operands(request)
+        self.grouping = grouping
+        self.names = grouping.keys() if grouping is not None else []
+        self.fields = self.names + [operand for okey, op, operand 
+                                    in self.operands]
+        self.operators = [op for okey, op, operand in self.operands]
+        self.rest = rest
+
+    def output(self, aggregate):
+        order = _order(self.operands)
+        if self.grouping is None:
+            if not aggregate:
+                return {}
+            accs = aggregate[()]
+            return dict([(self.operands[i][0],accs[i].result()) 
+                         for i in order])
+        output = []
+        for k, accs in aggregate.items():
+            ret = {}
+            for gk, gv in zip(self.grouping.values(),k):
+                ret[gk] = gv
+            red = {}
+            for i in order:
+                red[self.operands[i][0]] = accs[i].result()
+            ret.update(red)
+            output.append(ret)
+        return output
+
+
+def plan(request):
+    """Plan of a pipeline that can run partitioned, else None."""
+    try:
+        stages = [req.items()[0] for req in request]
+        flattened = bool(stages) and stages[0][0] == '$flatten' and stages[0][1]
+        if flattened:
+            stages = stages[1:]
+        name, arg = stages[0]
+        if name == '$reduce':
+            result = Plan(arg, None, request[len(request)-len(stages)+1:])
+        elif name == '$group' and flattened:
+            arg, grouping = _grouping(arg)
+            result = Plan(arg, grouping, request[len(request)-len(stages)+1:])
+        else:
+            return None
+    except Exception:
+        return None
+    if '$children' in result.fields or '_children' in result.fields:
+        return None
+    if not all([hasattr(apply.accumulators[op], 'combine') 
+                for op in result.operators]):
+        return None
+    return result
+
+def processes():
+    return PROCESSES or multiprocessing.cpu_count()
+
+def aggregate(plan, rows):
+    """
+    Combined accumulators of plan over rows, keyed by group. Up to
+    PARALLEL_ROWS rows are reduced here, more are cut in partitions
+    of PARTITION_ROWS handed to the process pool, with at most two
+    per process in flight. Without a pool all rows are reduced here.
+    """
+    pool = _pool
+    head = list(islice(rows, PARALLEL_ROWS))
+    if len(head) < PARALLEL_ROWS or pool is None:
+        return _partial((plan.operators, len(plan.names), chain(head, rows)))
+    total = {}
+    pending = deque()
+    rows = chain(head, rows)
+    while True:
+        partition = list(islice(rows, PARTITION_ROWS))
+        if partition:
+            task = (plan.operators, len(plan.names), partition)
+            pending.append(pool.apply_async(_partial, (task,)))
+        if pending and (not partition or len(pending) >= 2*processes()):
+            _combine(total, pending.popleft().get())
+        if not partition and not pending:
+            return total
+
+def startPool():
+    """
+    Forks the process pool when PROCESSES asks for more than one. The
+    server calls it before starting any thread, as a fork made later
+    copies locks other threads may hold.
+    """
+    global _pool
+    if _pool is None and processes() > 1:
+        _pool = multiprocessing.Pool(processes())
+
+def stopPool():
+    global _pool
+    if _pool is not None:
+        _pool.terminate()
+        _pool.join()
+        _pool = None
+
+def _partial(task):
+    operators, keys, rows = task
+    accumulators = [apply.accumulators[op] for op in operators]
+    aggregate = {}
+    updates = {}
+    for row in rows:
+        key = row[:keys]
+        update = updates.get(key)
+        if update is None:
+            accs = aggregate[key] = [acc() for acc in accumulators]
+            update = updates[key] = [acc.update for acc in accs]
+        for fn, value in zip(update, row[keys:]):
+            fn(value)
+    return aggregate
+
+def _combine(total, partial):
+    for key, accs in partial.iteritems():
+        mine = total.get(key)
+        if mine is None:
+            total[key] = accs
+        else:
+            for acc, other in zip(mine, accs):
+                acc.combine(other)
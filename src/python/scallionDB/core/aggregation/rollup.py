@@ -0,0 +1,63 @@
+''' 
+  Licensed under the Apache License, Version 2.0 (the "License"); you may
+  not use this file except in compliance with the License. You may obtain
+  a copy of the License at
+ 
+      http://www.apache.org/licenses/LICENSE-2.0
+ 
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+ '''
+
+from parallel import Plan
+from apply import accumulators
+
+ROLLUP_REFERENCES = ['SELF','CHILDREN','DESCENDANTS']
+
+
+def plan(request):
+    """
+    Plan of a pipeline starting with a $rollup, None for other
+    pipelines. $rollup takes the operands of a $reduce, whose
+    functions must combine independently of row order.
+    """
+    if not isinstance(request,list) or not request:
+        return None
+    if not isinstance(request[0],dict) or request[0].keys() != ['$rollup']:
+        return None
+    try:
+        result = Plan(request[0]['$rollup'],None,request[1:])
+    except SyntaxError:
+        raise
+    except Exception:
+        raise SyntaxError("Invalid $rollup request %s" %str(request[0]))
+    for op in result.operators:
+        if op == '$append' or not hasattr(accumulators[op],'combine'):
+            raise SyntaxError("%s cannot be rolled up" %op)
+    if '$children' in result.fields or '_children' in result.fields:
+        raise SyntaxError("$rollup cannot read _children")
+    return result
+
+def totals(plan, top, pick):
+    """
+    Post order walk of top and the nodes under it yielding every node
+    with the accumulators of its descendants. A node is folded into
+    its parent once the loop body has used its accumulators.
+    """
+    new = lambda: [accumulators[op]() for op in plan.operators]
+    stack = [(top, iter(top['_children']), new())]
+    while stack:
+        node, children, accs = stack[-1]
+        for child in children:
+            stack.append((child, iter(child['_children']), new()))
+            break
+        else:
+            stack.pop()
+            yield node, accs
+            if stack:
+                for acc, value, below in zip(stack[-1][2],pick(node),accs):
+                    acc.update(value)
+                    acc.combine(below)
@@ -0,0 +1,51 @@
+''' 
+  Licensed under the Apache License, Version 2.0 (the "License"); you may
+  not use this file except in compliance with the License. You may obtain
+  a copy of the License at
+ 
+      http://www.apache.org/licenses/LICENSE-2.0
+ 
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+ '''
+
+from itertools import chain
+
+
+class Parts(object):
+    """
+    Result made of one sequence of rows per selected node. Parts and
+    their rows are produced lazily, stages are applied part by part.
+    """
+
+    def __init__(self, parts):
+        self.parts = parts
+
+    def __iter__(self):
+        return iter(self.parts)
+
+    def map(self, fn):
+        return Parts(fn(part) for part in self.parts)
+
+    def rows(self):
+        return chain.from_iterable(self.parts)
+
+
+def nested(result):
+    """result as Parts if it is made of parts, None if it is flat."""
+    if isinstance(result, Parts):
+        return result
+    if isinstance(result, list) and result and isinstance(result[0], list):
+        return Parts(result)
+    return None
+
+def collect(result):
+    """Materializes what the last stage of a pipeline returned."""
+    if isinstance(result, dict):
+        return result
+    if isinstance(result, Parts):
+        return [collect(part) for part in result]
+    return list(result)
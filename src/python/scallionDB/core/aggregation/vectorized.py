@@ -0,0 +1,109 @@
+''' 
+  Licensed under the Apache License, Version 2.0 (the "License"); you may
+  not use this file except in compliance with the License. You may obtain
+  a copy of the License at
+ 
+      http://www.apache.org/licenses/LICENSE-2.0
+ 
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+ '''
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+VECTOR_ROWS = 1000
+EXACT = 1 << 53
+NUMBERS = set([int, long, float, type(None)])
+REDUCERS = ('$sum', '$sum1', '$count', '$avg', '$avg1', 
+            '$minimum', '$maximum')
+
+
+def usable(operators, rows=None):
+    """Whether rows are worth handing to numpy for these operators,
+    or whether numpy can take them at all when rows is None."""
+    return (numpy is not None and all([op in REDUCERS for op in operators])
+            and (rows is None or len(rows) >= VECTOR_ROWS))
+
+def _number(value, integral):
+    if integral:
+        return int(value)
+    return float(value)
+
+
+class Groups(object):
+    """
+    Rows factorized into integer group codes. reduce computes an
+    operator for every group at once, or returns None when the result
+    could differ from the pure Python operators in value or type.
+    """
+
+    def __init__(self, codes, count):
+        self.codes = numpy.array(codes, dtype=numpy.intp)
+        self.count = count
+        self.sizes = numpy.bincount(self.codes, minlength=count)
+        self.order = None
+
+    def _segments(self):
+        if self.order is None:
+            self.order = numpy.argsort(self.codes, kind='mergesort')
+            self.starts = numpy.concatenate(([0], 
+                                             numpy.cumsum(self.sizes)[:-1]))
+        return self.order, self.starts
+
+    def reduce(self, operator, values):
+        if operator == '$sum1':
+            return [int(n) for n in self.sizes]
+        kinds = set(map(type, values))
+        if not kinds <= NUMBERS:
+            return None
+        try:
+            column = numpy.array(values, dtype=float)
+        except OverflowError:
+            return None
+        present = ~numpy.isnan(column)
+        if len(column) - present.sum() != values.count(None):
+            return None
+        codes = self.codes[present]
+        counts = numpy.bincount(codes, minlength=self.count)
+        if operator == '$count':
+            return [int(n) for n in counts]
+        if int in kinds or long in kinds:
+            if numpy.abs(column[present]).sum() >= EXACT:
+                return None
+        if float not in kinds:
+            floats = numpy.zeros(self.count, dtype=numpy.intp)
+        elif kinds <= set([float, type(None)]):
+            floats = counts
+        else:
+            isfloat = numpy.array([type(v) is float for v in values])
+            floats = numpy.bincount(self.codes[isfloat], minlength=self.count)
+
+        if operator in ('$sum', '$avg', '$avg1'):
+            sums = numpy.bincount(codes, weights=column[present],
+                                  minlength=self.count)
+            if operator == '$sum':
+                return [_number(s, not f) for s, f in zip(sums, floats)]
+            if operator == '$avg':
+                return [float(s)/int(n) for s, n in zip(sums, self.sizes)]
+            return [float(s)/int(n) if n else 0 for s, n in zip(sums, counts)]
+
+        if ((floats > 0) & (floats < counts)).any():
+            return None
+        if float in kinds and numpy.signbit(column[column == 0]).any():
+            return None
+        order, starts = self._segments()
+        if operator == '$minimum':
+            column[~present] = numpy.inf
+            found = numpy.minimum.reduceat(column[order], starts)
+            return [_number(v, not f) if c == n else None
+                    for v, f, c, n in zip(found, floats, counts, self.sizes)]
+        column[~present] = -numpy.inf
+        found = numpy.maximum.reduceat(column[order], starts)
+        return [_number(v, not f) if c else None
+                for v, f, c in zip(found, floats, counts)]
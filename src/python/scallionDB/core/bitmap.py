@@ -0,0 +1,341 @@
+''' 
+  Licensed under the Apache License, Version 2.0 (the "License"); you may
+  not use this file except in compliance with the License. You may obtain
+  a copy of the License at
+ 
+      http://www.apache.org/licenses/LICENSE-2.0
+ 
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+ '''
+
+from array import array
+from binascii import hexlify, unhexlify
+from bisect import bisect_left
+from collections import defaultdict
+
+ARRAY_MAX = 4096
+CHUNK = 1 << 16
+
+
+def _long(chunk):
+    return long(hexlify(str(chunk[::-1])), 16)
+
+def _chunk(mask):
+    chunk = bytearray(unhexlify(('%x' % mask).zfill(CHUNK >> 2)))
+    chunk.reverse()
+    return chunk
+
+def _bits(mask):
+    """Positions of the set bits of mask, in ascending order."""
+    bits = bin(mask)[:1:-1]
+    i = bits.find('1')
+    while i >= 0:
+        yield i
+        i = bits.find('1', i + 1)
+
+def _mask(values):
+    chunk = bytearray(CHUNK >> 3)
+    for v in values:
+        chunk[v >> 3] |= 1 << (v & 7)
+    return chunk
+
+def _unique(values):
+    """Sorts values in place and drops duplicates."""
+    values.sort()
+    if len(set(values)) == len(values):
+        return values
+    return [v for i, v in enumerate(values) if not i or values[i - 1] != v]
+
+def _container(values):
+    """Array container for up to ARRAY_MAX sorted values, else a bitmap."""
+    if len(values) > ARRAY_MAX:
+        return _mask(values)
+    return array('H', values)
+
+def _fromlong(mask):
+    if not mask:
+        return None
+    if bin(mask).count('1') > ARRAY_MAX:
+        return _chunk(mask)
+    return array('H', _bits(mask))
+
+def _cardinality(c):
+    if isinstance(c, array):
+        return len(c)
+    return bin(_long(c)).count('1')
+
+def _copy(c):
+    return c[:]
+
+
+class Bitmap(object):
+    """
+    Compressed set of non negative integers in the manner of roaring
+    bitmaps. Members are split on their high bits into chunks of
+    CHUNK values. A chunk holding up to ARRAY_MAX members is a sorted
+    array of the low bits, a denser one a bytearray with one bit per
+    value. Set algebra on two dense chunks runs on longs. The methods
+    mirror the parts of the set interface used on id sets.
+    """
+
+    __slots__ = ('containers', 'size')
+
+    def __init__(self, values=()):
+        self.containers = {}
+        self.size = 0
+        if isinstance(values, Bitmap):
+            for high, c in values.containers.iteritems():
+                self.containers[high] = _copy(c)
+            self.size = values.size
+            return
+        chunks = defaultdict(list)
+        for v in values:
+            chunks[v >> 16].append(v & 0xFFFF)
+        for high, lows in chunks.iteritems():
+            self.containers[high] = _container(_unique(lows))
+        if chunks:
+            self.size = None
+
+    def __len__(self):
+        if self.size is None:
+            self.size = sum([_cardinality(c) 
+                             for c in self.containers.itervalues()])
+        return self.size
+
+    def __nonzero__(self):
+        return bool(self.containers)
+
+    def __contains__(self, value):
+        c = self.containers.get(value >> 16)
+        if c is None:
+            return False
+        low = value & 0xFFFF
+        if isinstance(c, array):
+            i = bisect_left(c, low)
+            return i < len(c) and c[i] == low
+        return bool(c[low >> 3] >> (low & 7) & 1)
+
+    def __iter__(self):
+        for high in sorted(self.containers):
+            c = self.containers[high]
+            base = high << 16
+            if isinstance(c, array):
+                for low in c:
+                    yield base | low
+            else:
+                for low in _bits(_long(c)):
+                    yield base | low
+
+    def __eq__(self, other):
+        if not isinstance(other, Bitmap):
+            return NotImplemented
+        if sorted(self.containers) != sorted(other.containers):
+            return False
+        for high, c in self.containers.iteritems():
+            d = other.containers[high]
+            if type(c) is type(d):
+                if c != d:
+                    return False
+            elif list(_iterate(c)) != list(_iterate(d)):
+                return False
+        return True
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __repr__(self):
+        return "Bitmap(%r)" % (list(self),)
+
+    def copy(self):
+        return Bitmap(self)
+
+    def add(self, value):
+        high, low = value >> 16, value & 0xFFFF
+        c = self.containers.get(high)
+        if c is None:
+            self.containers[high] = array('H', [low])
+        elif isinstance(c, array):
+            i = bisect_left(c, low)
+            if i < len(c) and c[i] == low:
+                return
+            if len(c) < ARRAY_MAX:
+                c.insert(i, low)
+            else:
+                c = self.containers[high] = _mask(c)
+                c[low >> 3] |= 1 << (low & 7)
+        else:
+            bit = 1 << (low & 7)
+            if c[low >> 3] & bit:
+                return
+            c[low >> 3] |= bit
+        if self.size is not None:
+            self.size += 1
+
+    def discard(self, value):
+        high, low = value >> 16, value & 0xFFFF
+        c = self.containers.get(high)
+        if c is None:
+            return
+        if isinstance(c, array):
+            i = bisect_left(c, low)
+            if i == len(c) or c[i] != low:
+                return
+            del c[i]
+            if not c:
+                del self.containers[high]
+        else:
+            bit = 1 << (low & 7)
+            if not c[low >> 3] & bit:
+                return
+            c[low >> 3] &= ~bit & 0xFF
+            if not c[low >> 3] and c.count('\x00') == len(c):
+                del self.containers[high]
+        if self.size is not None:
+            self.size -= 1
+
+    def update(self, *others):
+        """Adds the members of all others, merging each chunk once."""
+        chunks = defaultdict(list)
+        for other in others:
+            if not isinstance(other, Bitmap):
+                other = Bitmap(other)
+            for high, c in other.containers.iteritems():
+                chunks[high].append(c)
+        for high, cs in chunks.iteritems():
+            mine = self.containers.get(high)
+            self.containers[high] = _merge(mine, cs)
+        if chunks:
+            self.size = None
+
+    def intersection_update(self, other):
+        if not isinstance(other, Bitmap):
+            other = Bitmap(other)
+        for high in self.containers.keys():
+            c = other.containers.get(high)
+            if c is not None:
+                c = _intersection(self.containers[high], c)
+            if c is None:
+                del self.containers[high]
+            else:
+                self.containers[high] = c
+        self.size = None
+
+    def difference_update(self, other):
+        if not isinstance(other, Bitmap):
+            other = Bitmap(other)
+        for high, c in other.containers.iteritems():
+            mine = self.containers.get(high)
+            if mine is None:
+                continue
+            mine = _difference(mine, c)
+            if mine is None:
+                del self.containers[high]
+            else:
+                self.containers[high] = mine
+        self.size = None
+
+    def __and__(self, other):
+        if len(self.containers) > len(other.containers):
+            self, other = other, self
+        bitmap = Bitmap()
+        for high, c in self.containers.iteritems():
+            d = other.containers.get(high)
+            if d is not None:
+                c = _intersection(c, d)
+                if c is not None:
+                    bitmap.containers[high] = c
+        bitmap.size = None
+        return bitmap
+
+    def __or__(self, other):
+        bitmap = self.copy()
+        bitmap.update(other)
+        return bitmap
+
+    def __sub__(self, other):
+        bitmap = self.copy()
+        bitmap.difference_update(other)
+        return bitmap
+
+
+def _iterate(c):
+    if isinstance(c, array):
+        return iter(c)
+    return _bits(_long(c))
+
+def _merge(mine, cs):
+    """Union of the chunk mine (may be None) with the chunks in cs."""
+    if mine is not None and not isinstance(mine, array):
+        chunk = mine
+    else:
+        dense = [c for c in cs if not isinstance(c, array)]
+        if dense:
+            chunk = dense[0][:]
+            cs = [c for c in cs if c is not dense[0]]
+            if mine is not None:
+                cs.append(mine)
+        else:
+            arrays = sorted(cs, key=len, reverse=True)
+            big = mine if mine is not None else arrays.pop(0)
+            extra = sum([len(a) for a in arrays])
+            if extra * 16 <= len(big):
+                merged = big[:]
+                for a in arrays:
+                    for v in a:
+                        i = bisect_left(merged, v)
+                        if i == len(merged) or merged[i] != v:
+                            merged.insert(i, v)
+                if len(merged) > ARRAY_MAX:
+                    return _mask(merged)
+                return merged
+            values = big.tolist()
+            for a in arrays:
+                values.extend(a)
+            return _container(_unique(values))
+    dense = [c for c in cs if not isinstance(c, array)]
+    if dense:
+        mask = _long(chunk)
+        for c in dense:
+            mask |= _long(c)
+        chunk = _chunk(mask)
+    for c in cs:
+        if isinstance(c, array):
+            for v in c:
+                chunk[v >> 3] |= 1 << (v & 7)
+    return chunk
+
+def _intersection(a, b):
+    if isinstance(a, array) and isinstance(b, array):
+        if len(a) > len(b):
+            a, b = b, a
+        values = set(b)
+        values = [v for v in a if v in values]
+        return array('H', values) if values else None
+    if isinstance(a, array) or isinstance(b, array):
+        if isinstance(b, array):
+            a, b = b, a
+        values = [v for v in a if b[v >> 3] >> (v & 7) & 1]
+        return array('H', values) if values else None
+    return _fromlong(_long(a) & _long(b))
+
+def _difference(a, b):
+    if isinstance(a, array):
+        if isinstance(b, array):
+            drop = set(b)
+            values = [v for v in a if v not in drop]
+        else:
+            values = [v for v in a if not b[v >> 3] >> (v & 7) & 1]
+        return array('H', values) if values else None
+    if isinstance(b, array):
+        a = bytearray(a)
+        for v in b:
+            a[v >> 3] &= ~(1 << (v & 7)) & 0xFF
+        return _fromlong(_long(a))
+    return _fromlong(_long(a) & ~_long(b))
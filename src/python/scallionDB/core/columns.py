@@ -0,0 +1,86 @@
+''' 
+  Licensed under the Apache License, Version 2.0 (the "License"); you may
+  not use this file except in compliance with the License. You may obtain
+  a copy of the License at
+ 
+      http://www.apache.org/licenses/LICENSE-2.0
+ 
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+ '''
+
+import calendar
+
+from array import array
+
+from bitmap import Bitmap
+
+EXACT = 1 << 53
+
+
+def numeric(value):
+    """True for the values a Column stores: floats, and ints small
+    enough to be exact as doubles."""
+    if type(value) is float:
+        return True
+    return type(value) in (int, long) and -EXACT <= value <= EXACT
+
+
+def epoch(stamp):
+    """
+    Seconds since the epoch of a timestamp as the tree indexes it, the
+    isoformat of the parsed datetime. Naive ones are taken as UTC.
+    """
+    if stamp[4:5] != '-' or stamp[10:11] != 'T':
+        raise ValueError("%s is not an ISO timestamp" %stamp)
+    seconds = calendar.timegm((int(stamp[0:4]), int(stamp[5:7]),
+                               int(stamp[8:10]), int(stamp[11:13]),
+                               int(stamp[14:16]), int(stamp[17:19])))
+    rest = stamp[19:]
+    if rest.startswith('.'):
+        seconds += int(rest[1:7]) / 1e6
+        rest = rest[7:]
+    if rest:
+        offset = int(rest[1:3])*3600 + int(rest[4:6])*60
+        seconds += offset if rest[0] == '-' else -offset
+    return seconds
+
+
+class Column(object):
+    """
+    Numeric values of one attribute in an array of doubles indexed by
+    node handle. valid holds the handles that have a value, floats the
+    ones whose value was a float rather than an int.
+    """
+
+    def __init__(self):
+        self.values = array('d')
+        self.valid = Bitmap()
+        self.floats = Bitmap()
+
+    def set(self, handle, value):
+        size = len(self.values)
+        if handle >= size:
+            grow = max(handle + 1 - size, size)
+            self.values.extend(array('d', [0.0]) * grow)
+        self.values[handle] = value
+        self.valid.add(handle)
+        if type(value) is float:
+            self.floats.add(handle)
+        else:
+            self.floats.discard(handle)
+
+    def discard(self, handle):
+        self.valid.discard(handle)
+        self.floats.discard(handle)
+
+    def gather(self, ids):
+        """Values of the handles in ids, in handle order, and how many
+        of them were floats."""
+        values = self.values
+        found = ids & self.valid
+        gathered = array('d', [values[h] for h in found])
+        return gathered, len(found & self.floats)
@@ -0,0 +1,221 @@
+''' 
+  Licensed under the Apache License, Version 2.0 (the "License"); you may
+  not use this file except in compliance with the License. You may obtain
+  a copy of the License at
+ 
+      http://www.apache.org/licenses/LICENSE-2.0
+ 
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+ '''
+
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+from treeutil import compileRegex, trigrams
+from bitmap import Bitmap
+
+TRIGRAM_THRESHOLD = 1024
+
+
+class ValueIndex(dict):
+    """
+    Distinct values of one attribute mapped to a Bitmap of the handles
+    of the nodes holding them. The values are also kept in a sorted
+    list so that range selectors only bisect instead of scanning every
+    value. Array values (stored as tuples) additionally post every
+    element to the ids holding it, so $in is a union and $contains an
+    intersection of element postings. Attributes get a trigram index
+    over their string values, for $regex, on the write that brings them
+    to TRIGRAM_THRESHOLD distinct values, so reads never change the
+    index. All ids holding the attribute are kept in ids, which answers
+    $exists and, as every node has one value per attribute, $neq.
+    """
+
+    def __init__(self):
+        dict.__init__(self)
+        self.ordered = []
+        self.tuples = set()
+        self.elements = defaultdict(Bitmap)
+        self.trigrams = None
+        self.ids = Bitmap()
+        self.size = 0
+
+    def add(self, value, id):
+        ids = self.get(value)
+        if ids is None:
+            ids = self[value] = Bitmap()
+            insort(self.ordered, value)
+            if isinstance(value, tuple):
+                self.tuples.add(value)
+            elif self.trigrams is not None and isinstance(value, basestring):
+                for gram in trigrams(value):
+                    self.trigrams[gram].add(value)
+            elif self.trigrams is None and len(self) >= TRIGRAM_THRESHOLD:
+                self.indexTrigrams()
+        if id in ids:
+            return
+        ids.add(id)
+        self.ids.add(id)
+        self.size += 1
+        if isinstance(value, tuple):
+            for e in value:
+                self.elements[e].add(id)
+
+    def discard(self, value, id):
+        ids = self.get(value)
+        if ids is None or id not in ids:
+            return
+        ids.discard(id)
+        self.ids.discard(id)
+        self.size -= 1
+        if isinstance(value, tuple):
+            for e in value:
+                posting = self.elements.get(e)
+                if posting is not None:
+                    posting.discard(id)
+                    if not posting:
+                        del self.elements[e]
+        if not ids:
+            del self[value]
+            self.tuples.discard(value)
+            if self.trigrams is not None and isinstance(value, basestring):
+                for gram in trigrams(value):
+                    keys = self.trigrams.get(gram)
+                    if keys is not None:
+                        keys.discard(value)
+                        if not keys:
+                            del self.trigrams[gram]
+            i = bisect_left(self.ordered, value)
+            if i < len(self.ordered) and self.ordered[i] == value:
+                del self.ordered[i]
+            else:
+                self.ordered.remove(value)
+
+    def select(self, value, operator):
+        if operator == '$lt':
+            return self.ordered[:bisect_left(self.ordered, value)]
+        if operator == '$lte':
+            return self.ordered[:bisect_right(self.ordered, value)]
+        if operator == '$gt':
+            return self.ordered[bisect_right(self.ordered, value):]
+        if operator == '$gte':
+            return self.ordered[bisect_left(self.ordered, value):]
+        raise ValueError("Range lookup needs one of $lt, $lte, $gt, $gte")
+
+    def nth(self, k, ids, size):
+        """
+        Value of rank k, 0 based, among the size values other than None
+        held by the handles in ids. Keys are walked from the nearer end,
+        and their postings counted whole when ids is None.
+        """
+        if k < size // 2:
+            keys, rank = iter(self.ordered), k
+        else:
+            keys, rank = reversed(self.ordered), size - 1 - k
+        seen = 0
+        for key in keys:
+            if key is None:
+                continue
+            seen += len(self[key]) if ids is None else len(self[key] & ids)
+            if seen > rank:
+                return key
+        raise IndexError("rank %d out of %d values" %(k,size))
+
+    def estimate(self, value, operator):
+        """Number of ids a selector on this attribute is expected to match."""
+        if operator == '$eq':
+            return len(self.get(value, ()))
+        if operator == '$neq':
+            return self.size - len(self.get(value, ()))
+        if operator == '$in':
+            return sum([len(self.get(v, ())) + len(self.elements.get(v, ()))
+                        for v in value if not isinstance(v, (list, dict))])
+        if operator == '$contains':
+            if not value:
+                return sum([len(self[key]) for key in self.tuples])
+            if any([isinstance(v, (list, dict)) for v in value]):
+                return 0
+            return min([len(self.elements.get(v, ())) for v in value])
+        if operator in ('$lt', '$lte', '$gt', '$gte'):
+            if operator == '$lt':
+                keys = bisect_left(self.ordered, value)
+            elif operator == '$lte':
+                keys = bisect_right(self.ordered, value)
+            elif operator == '$gt':
+                keys = len(self.ordered) - bisect_right(self.ordered, value)
+            else:
+                keys = len(self.ordered) - bisect_left(self.ordered, value)
+            return keys * self.size // max(len(self.ordered), 1)
+        return self.size
+
+    def regex(self, value):
+        pattern, prefix, literals = compileRegex(value)
+        if prefix:
+            candidates = []
+            for i in xrange(bisect_left(self.ordered, prefix),
+                            len(self.ordered)):
+                key = self.ordered[i]
+                if not (isinstance(key, basestring) and key.startswith(prefix)):
+                    break
+                candidates.append(key)
+        else:
+            grams = set()
+            for literal in literals:
+                grams.update(trigrams(literal))
+            index = self.trigrams
+            if grams and index is not None:
+                postings = sorted([index.get(g, ()) for g in grams],
+                                  key=len)
+                candidates = set(postings[0])
+                for posting in postings[1:]:
+                    if not candidates:
+                        break
+                    candidates.intersection_update(posting)
+            else:
+                candidates = [k for k in self if isinstance(k, basestring)]
+        return [k for k in candidates if pattern.search(k)]
+
+    def indexTrigrams(self):
+        """Builds the trigram index whole before publishing it."""
+        index = defaultdict(set)
+        for key in self:
+            if isinstance(key, basestring):
+                for gram in trigrams(key):
+                    index[gram].add(key)
+        self.trigrams = index
+
+    def lookup(self, value, operator):
+        if operator == '$eq':
+            return Bitmap(self.get(value, ()))
+        if operator == '$neq':
+            return self.ids - self.get(value, Bitmap())
+        if operator == '$in':
+            postings = []
+            for v in value:
+                if not isinstance(v, (list, dict)):
+                    postings.extend([self.get(v, ()), self.elements.get(v, ())])
+            ids = Bitmap()
+            ids.update(*postings)
+            return ids
+        if operator == '$contains':
+            if not value:
+                ids = Bitmap()
+                ids.update(*[self[key] for key in self.tuples])
+                return ids
+            postings = []
+            for v in value:
+                if isinstance(v, (list, dict)) or v not in self.elements:
+                    return Bitmap()
+                postings.append(self.elements[v])
+            postings.sort(key=len)
+            ids = postings[0].copy()
+            for posting in postings[1:]:
+                ids.intersection_update(posting)
+                if not ids:
+                    break
+            return ids
+        raise ValueError("Direct lookup needs one of $eq, $neq, $in, "
+                         "$contains")
@@ -0,0 +1,146 @@
+''' 
+  Licensed under the Apache License, Version 2.0 (the "License"); you may
+  not use this file except in compliance with the License. You may obtain
+  a copy of the License at
+ 
+      http://www.apache.org/licenses/LICENSE-2.0
+ 
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+ '''
+
+from bisect import bisect_right
+from bitmap import Bitmap
+
+SPACING = 1 << 32
+MIN_STEP = 1 << 8
+
+
+def tour(tree):
+    """
+    Depth first walk of tree yielding (node, True) when a node is
+    entered and (node, False) once all of its descendants are done.
+    """
+    stack = [(tree, True)]
+    while stack:
+        node, entering = stack.pop()
+        yield node, entering
+        if entering:
+            stack.append((node, False))
+            stack.extend([(child, True) for child in reversed(node['_children'])])
+
+
+class TourLabels(dict):
+    """
+    Euler tour (enter, exit) labels of every node of a tree, keyed by
+    _id. Queries take and return Bitmaps of node handles. A node lies
+    under another iff its enter label falls strictly inside the other's
+    interval. Labels are handed out SPACING apart so a new subtree
+    normally fits in the gap left under its parent; when a gap runs out
+    the closest enclosing subtree with room is relabeled into the first
+    half of its interval, keeping the rest free for later appends. The
+    root is implicit and spans every label.
+    """
+
+    def __init__(self, tree):
+        dict.__init__(self)
+        self.tree = tree
+
+    def insert(self, parent, node):
+        """Labels node, which was just appended to parent's children."""
+        siblings = parent['_children']
+        enter = self._enter(parent)
+        step = SPACING
+        if len(siblings) > 1:
+            lo = self[siblings[-2]['_id']][1]
+            # Space the newcomer like its elder siblings rather than
+            # filling the gap, so the room left lasts for many appends.
+            step = min(step, (lo - enter) // (2 * (len(siblings) - 1)))
+        else:
+            lo = enter
+        hi = self._exit(parent)
+        events = list(tour(node))
+        if hi is not None:
+            step = min(step, (hi - lo) // (len(events) + 1))
+        if step < 1:
+            self._relabel(parent)
+        else:
+            self._assign(events, lo, step)
+
+    def remove(self, id):
+        self.pop(id, None)
+
+    def within(self, ids, caps):
+        """
+        Returns the handles in ids lying strictly under at least one of
+        the handles in caps.
+        """
+        if 0 in caps:
+            return Bitmap(ids)
+        external = self.tree.external
+        starts = []
+        ends = []
+        for enter, exit in sorted([self[external[c]] for c in caps 
+                                   if external[c] in self]):
+            if ends and enter < ends[-1]:
+                continue
+            starts.append(enter)
+            ends.append(exit)
+        fids = Bitmap()
+        for id in ids:
+            enter = self[external[id]][0]
+            i = bisect_right(starts, enter) - 1
+            if i >= 0 and starts[i] < enter < ends[i]:
+                fids.add(id)
+        return fids
+
+    def stab(self, candidates, ids):
+        """Returns the candidates having at least one of ids under them."""
+        external = self.tree.external
+        points = sorted([self[external[id]][0] for id in ids 
+                         if external[id] in self])
+        stabbed = Bitmap()
+        for candidate in candidates:
+            enter, exit = self[external[candidate]]
+            i = bisect_right(points, enter)
+            if i < len(points) and points[i] < exit:
+                stabbed.add(candidate)
+        return stabbed
+
+    def _enter(self, node):
+        if node['_id'] == '_ROOT':
+            return 0
+        return self[node['_id']][0]
+
+    def _exit(self, node):
+        if node['_id'] == '_ROOT':
+            return None
+        return self[node['_id']][1]
+
+    def _assign(self, events, lo, step):
+        label = lo
+        entered = {}
+        for node, entering in events:
+            label += step
+            if entering:
+                entered[node['_id']] = label
+            else:
+                self[node['_id']] = (entered.pop(node['_id']), label)
+
+    def _relabel(self, node):
+        while node['_id'] != '_ROOT':
+            enter, exit = self[node['_id']]
+            events = list(tour(node))[1:-1]
+            step = (exit - enter) // (2 * (len(events) + 1))
+            if step >= MIN_STEP:
+                self._assign(events, enter, min(SPACING, step))
+                return
+            parentID = self.tree.parentChildMap[node['_id']]
+            if parentID == '_ROOT':
+                node = self.tree
+            else:
+                node = self.tree.PM[parentID]
+        self._assign(list(tour(self.tree))[1:-1], 0, SPACING)
@@ -0,0 +1,233 @@
+''' 
+  Licensed under the Apache License, Version 2.0 (the "License"); you may
+  not use this file except in compliance with the License. You may obtain
+  a copy of the License at
+ 
+      http://www.apache.org/licenses/LICENSE-2.0
+ 
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+ '''
+
+from operator import itemgetter
+from weakref import WeakValueDictionary
+
+
+class Shape(object):
+    """
+    Sorted attribute names of a node, in storage order. Shapes are
+    interned, so nodes with the same keys share one Shape and its
+    offsets, and the table only holds them while some node does.
+    """
+    __slots__ = ('keys', 'offsets', '__weakref__')
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.offsets = dict([(k, i) for i, k in enumerate(keys)])
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key):
+        return shape(self.keys + (key,))
+
+    def remove(self, key):
+        return shape([k for k in self.keys if k != key])
+
+shapes = WeakValueDictionary()
+
+def shape(keys):
+    keys = tuple(sorted(keys))
+    found = shapes.get(keys)
+    if found is None:
+        found = shapes[keys] = Shape(keys)
+    return found
+
+EMPTY = shape(())
+
+
+class Node(object):
+    """
+    Tree node stored as its _id, its children (None for a leaf), an
+    interned Shape and a tuple of attribute values. It answers the
+    part of the dict interface the tree code uses, with _id and
+    _children appearing as ordinary keys. A leaf hands out a fresh
+    empty list as _children, so children are added with adopt and
+    removed with disown. Attribute values go through intern, when
+    given, on the way in.
+    """
+
+    __slots__ = ('_id', 'children', 'shape', 'data')
+
+    def __init__(self, attrs=None, intern=None):
+        if not isinstance(attrs, dict):
+            raise TypeError("Node should be Object Type")
+        self._id = attrs.get('_id')
+        self.children = None
+        self.shape = shape([k for k in attrs 
+                            if k != '_id' and k != '_children'])
+        if intern is None:
+            self.data = tuple([attrs[k] for k in self.shape.keys])
+        else:
+            self.data = tuple([intern(attrs[k]) for k in self.shape.keys])
+
+    def __getitem__(self, key):
+        if key == '_children':
+            if self.children is None:
+                return []
+            return self.children
+        if key == '_id':
+            if self._id is None:
+                raise KeyError(key)
+            return self._id
+        return self.data[self.shape.offsets[key]]
+
+    def __setitem__(self, key, value):
+        if key == '_children':
+            self.children = value or None
+        elif key == '_id':
+            self._id = value
+        elif key in self.shape.offsets:
+            i = self.shape.offsets[key]
+            self.data = self.data[:i] + (value,) + self.data[i+1:]
+        else:
+            self.shape = self.shape.add(key)
+            i = self.shape.offsets[key]
+            self.data = self.data[:i] + (value,) + self.data[i:]
+
+    def __delitem__(self, key):
+        if key == '_children' or key == '_id':
+            raise KeyError("attribute cannot be %s " %key)
+        i = self.shape.offsets[key]
+        self.shape = self.shape.remove(key)
+        self.data = self.data[:i] + self.data[i+1:]
+
+    def __contains__(self, key):
+        if key == '_children':
+            return True
+        if key == '_id':
+            return self._id is not None
+        return key in self.shape.offsets
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def iterkeys(self):
+        if self._id is not None:
+            yield '_id'
+        for k in self.shape.keys:
+            yield k
+        yield '_children'
+
+    __iter__ = iterkeys
+
+    def iteritems(self):
+        for k in self.iterkeys():
+            yield k, self[k]
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return [v for k, v in self.iteritems()]
+
+    def __len__(self):
+        return len(self.shape.keys) + 1 + (self._id is not None)
+
+    def __eq__(self, other):
+        if isinstance(other, Node):
+            if self._id != other._id:
+                return False
+            other = todict(other)
+        elif not isinstance(other, dict):
+            return NotImplemented
+        return todict(self) == other
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(todict(self))
+
+    def adopt(self, child):
+        if self.children is None:
+            self.children = [child]
+        else:
+            self.children.append(child)
+
+    def disown(self, child):
+        """Drops child by identity, returns False if it is not a child."""
+        for i, c in enumerate(self.children or ()):
+            if c is child:
+                del self.children[i]
+                if not self.children:
+                    self.children = None
+                return True
+        return False
+
+
+def picker(keys):
+    """
+    Function giving the tuple of values of keys in a node, None for
+    missing attributes. Offsets are looked up once per shape, which
+    is kept with its getter so that its id is not reused meanwhile.
+    """
+    keys = tuple(keys)
+    getters = {}
+    def pick(node):
+        entry = getters.get(id(node.shape))
+        if entry is None:
+            entry = getters[id(node.shape)] = (node.shape, 
+                                               _getter(node.shape, keys))
+        return entry[1](node)
+    return pick
+
+def _getter(shape, keys):
+    offsets = shape.offsets
+    if len(keys) > 1 and all([k in offsets for k in keys]):
+        get = itemgetter(*[offsets[k] for k in keys])
+        return lambda node: get(node.data)
+    return lambda node: tuple([node.data[offsets[k]] if k in offsets else
+                               node._id if k == '_id' else None 
+                               for k in keys])
+
+def todict(node):
+    """Plain dict of a node, its children left as they are. Doubles as
+    the default hook of json.dumps."""
+    if not isinstance(node, Node):
+        raise TypeError("%r is not JSON serializable" % (node,))
+    return dict(node.iteritems())
+
+def toNode(tree, intern=None):
+    """Node tree with the attributes and children of a dict tree."""
+    root = Node(tree, intern)
+    stack = [(root, tree)]
+    while stack:
+        node, attrs = stack.pop()
+        children = attrs.get('_children')
+        if children is None:
+            continue
+        if not isinstance(children, list):
+            raise TypeError("_children attribute should be of Array Type")
+        nodes = [Node(child, intern) for child in children]
+        node.children = nodes or None
+        stack.extend(zip(nodes, children))
+    return root
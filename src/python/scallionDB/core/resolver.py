@@ -16,7 +16,22 @@ import json
 import traceback
 import os
 import shutil
-from tree import Tree
+from tree import Tree, REFERENCES
+
+def resultKey(parsed):
+    """
+    Key of a GET or AGGREGATE result in its tree's result cache, None
+    for requests whose result is not cached.
+    """
+    if parsed['request'] not in ('GET','AGGREGATE'):
+        return None
+    selector = json.dumps(json.loads(parsed['selector']),sort_keys=True)
+    refs = parsed['reference'].split(',')
+    reference = ','.join([r for r in REFERENCES if r in refs])
+    attrs = parsed['attrs']
+    if attrs and attrs != '*':
+        attrs = json.dumps(json.loads(attrs),sort_keys=True)
+    return (parsed['request'],selector,reference,attrs)
 
 def evaluate(trees,parsed,folder):
     treename =  parsed['tree']
@@ -60,6 +75,20 @@ def evaluate(trees,parsed,folder):
             return tree.GET(selector,reference)
     elif req == 'AGGREGATE':
         return tree.AGGREGATE(selector,reference,attrs)
+    elif req == 'EXPLAIN':
+        return tree.EXPLAIN(selector)
+    elif req == 'DESCRIBE':
+        return tree.DESCRIBE(selector)
+    elif req == 'STATS':
+        return json.dumps({'version':tree.version,
+                           'results':tree.results.stats(),
+                           'strings':tree.strings.stats()})
+    elif req == 'REGISTER':
+        return tree.REGISTER(parsed['view'],selector,reference,attrs)
+    elif req == 'VIEW':
+        return tree.VIEW(parsed['view'])
+    elif req == 'UNREGISTER':
+        return tree.UNREGISTER(parsed['view'])
     elif req == 'DELETE':
         if attrs: 
             return tree.DELETE(selector,reference,attrs)
@@ -0,0 +1,83 @@
+''' 
+  Licensed under the Apache License, Version 2.0 (the "License"); you may
+  not use this file except in compliance with the License. You may obtain
+  a copy of the License at
+ 
+      http://www.apache.org/licenses/LICENSE-2.0
+ 
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+ '''
+
+import sys
+
+
+class StringTable(object):
+    """
+    Canonical copies of the string values a tree stores, so equal text
+    is stored once. A string is admitted on its second sighting, so
+    values seen once do not crowd out repeated ones, and only while
+    fewer than size are held. Each copy counts the stored values that
+    refer to it and is dropped when release brings that to zero. Only
+    strings of the same type are folded together.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.strings = {}
+        self.counts = {}
+        self.seen = set()
+        self.hits = 0
+        self.saved = 0
+
+    def intern(self, value):
+        """value with its strings, and those of its lists and objects,
+        replaced by canonical copies."""
+        if isinstance(value, basestring):
+            found = self.strings.get(value)
+            if found is None:
+                if value not in self.seen:
+                    if len(self.seen) >= self.size:
+                        self.seen.clear()
+                    self.seen.add(value)
+                    return value
+                if len(self.strings) >= self.size:
+                    return value
+                self.seen.discard(value)
+                found = self.strings[value] = value
+                self.counts[value] = 0
+            elif found is not value:
+                if type(found) is not type(value):
+                    return value
+                self.hits += 1
+                self.saved += sys.getsizeof(value)
+            self.counts[found] += 1
+            return found
+        if isinstance(value, list):
+            return [self.intern(v) for v in value]
+        if isinstance(value, dict):
+            return dict([(self.intern(k), self.intern(v)) 
+                         for k, v in value.iteritems()])
+        return value
+
+    def release(self, value):
+        """Forgets the references value holds to canonical copies."""
+        if isinstance(value, basestring):
+            if self.strings.get(value) is value:
+                self.counts[value] -= 1
+                if not self.counts[value]:
+                    del self.strings[value], self.counts[value]
+        elif isinstance(value, list):
+            for v in value:
+                self.release(v)
+        elif isinstance(value, dict):
+            for k, v in value.iteritems():
+                self.release(k)
+                self.release(v)
+
+    def stats(self):
+        return {'size': len(self.strings), 'capacity': self.size,
+                'hits': self.hits, 'saved': self.saved}
@@ -19,66 +19,96 @@ import traceback
 from copy import deepcopy
 from collections import defaultdict
 
-from scallionDB.parser.selection import Selector, Operator
-from treeutil import evaluate, flattenTree, traverse, generateID
-from treeutil import  filterByRelation, treebreaker
+from scallionDB.parser.constants import range_relational, lookup_relational
+from treeutil import flattenTree, traverse, generateID, compileSelector
+from treeutil import  filterByRelation, matchRelation, treebreaker, _or
 from listutil import listFuncs
 from dateutil import parser as tsparser
-from aggregation import pipeline
+from aggregation import pipeline, projection, stamped, parallel, rollup
+from aggregation.stream import Parts
+from index import ValueIndex
+from labels import TourLabels
+from cache import LRUCache
+from strings import StringTable
+from columns import Column, numeric, epoch, EXACT
+from aggregation.apply import columnar, accumulators
+from aggregation.apply import _middle, _rank, _select
+from aggregation.operators import _operands
+from bitmap import Bitmap
+from node import Node, toNode, picker
+from views import View
 
 REFERENCES = ['ANCESTORS','PARENT','SELF','CHILDREN','DESCENDANTS']
+VERIFY_COST = 4
+RESULT_CACHE_SIZE = 128
+RESULT_CACHE_BYTES = 1 << 20
+STRING_TABLE_SIZE = 1 << 18
+NUMERIC_COLUMNS = True
 
 class Tree(dict):
 
     def __init__(self, name):
         self.name = name
-        self.RI = defaultdict(lambda: defaultdict(set))
+        self.RI = defaultdict(ValueIndex)
         self.PM = {}
+        self.handles = {'_ROOT':0}
+        self.external = ['_ROOT']
+        self.sizes = [1]
+        self.depths = [0]
+        self.free = []
+        self.live = Bitmap()
         self.tsAttrs = {}
         self.parentChildMap = {}		
+        self.labels = TourLabels(self)
+        self.version = 0
+        self.results = LRUCache(RESULT_CACHE_SIZE)
+        self.strings = StringTable(STRING_TABLE_SIZE)
+        self.columns = {}
+        self.objects = defaultdict(Bitmap)
+        self.stamps = {}
+        self.views = {}
         self['_id'] = '_ROOT'		
         self['_children'] = []
 		
     def GET(self,expr,ref,attrs=[]):
-        expr = json.loads(expr)
-        if isinstance(expr,dict):
-            expr = [expr]
-        ids = set(['_ROOT'])	
-        for exp in expr:
-            ids = self._getAllID(exp,ids)       		
+        ids = self._select(expr)
         getNodes = []
         attrNodes = []
         for id in ids:
-            nodes = self._getNodes(id,ref)          
+            nodes = self._getNodes(self.external[id],ref)          
             getNodes.extend(nodes)	
             attrNodes.append(nodes)			
         if not attrs:
             return getNodes					
         else:
-            getAttrs = []
-            for nodes in attrNodes:	
-                temp = []  
-                for node in nodes:			
-                    if isinstance(attrs,list):
-                        if '_id' not in attrs:
-                            attrs.append('_id')
-                        all = False
-                    elif attrs == '*':
-                        all = True
-                    if all:
-                        attr = [a for a in node.keys() if a != '_children']
-                        attr.append('$children')
-                    else:
-                        attr = attrs
-                    select = {k:node.get(k) for k in attr if k in node}
-                    if '$children' in attr:
-                        select['$children'] = [c['_id'] for c in node['_children']]
-                    temp.append(select)
-                getAttrs.append(temp)
-            return getAttrs
+            if isinstance(attrs,list) and '_id' not in attrs:
+                attrs.append('_id')
+            return [[self._project(node,attrs) for node in nodes] 
+                    for nodes in attrNodes]
+
+    def _picker(self,keys):
+        """Tuples of the values of keys in nodes, the root included."""
+        pick = picker(keys)
+        def row(node):
+            if node is self:
+                return tuple([self.get(k) for k in keys])
+            return pick(node)
+        return row
+
+    def _project(self,node,attrs):
+        if attrs == '*':
+            attr = [a for a in node.keys() if a != '_children']
+            attr.append('$children')
+        else:
+            attr = attrs
+        select = {k:node.get(k) for k in attr if k in node}
+        if '$children' in attr:
+            select['$children'] = [c['_id'] for c in node['_children']]
+        return select
 			
     def PUT(self,expr,ref,tree={},attrs={}):
  
+        self._mutated()
         nodes = self.GET(expr,ref)
         if len(nodes) > 1 and tree.has_key('_id'):
             raise KeyError("More than one node to PUT wit same ID")
@@ -117,6 +147,7 @@ class Tree(dict):
             return self.PUT('{}','SELF',root)
 		
     def DELETE(self,expr,ref,attrs=[]): 
+        self._mutated()
         nodes = self.GET(expr,ref) 
         treeIDs = []
         for node in nodes:
@@ -144,9 +175,140 @@ class Tree(dict):
         gc.collect()		
         return treeIDs          
 		
+    def EXPLAIN(self,expr):
+        ids = Bitmap([0])
+        plans = []
+        for node in compileSelector(expr):
+            plan = []
+            ids = self._getAllID(node,ids,plan)
+            plans.append(plan[0])
+        return plans
+		
+    def DESCRIBE(self,expr):
+        """
+        Depth, number of children and subtree size, the node itself
+        included, of the selected nodes. The root has depth 0 and its
+        size counts every node of the tree.
+        """
+        return [{'_id':self.external[h],'depth':self.depths[h],
+                 'children':len(self._node(h)['_children']),
+                 'size':self.sizes[h]} for h in self._select(expr)]
+
+    def _node(self,h):
+        return self if h == 0 else self.PM[self.external[h]]
+
     def AGGREGATE(self,expr,ref,agg):
-        result = self.GET(expr,ref,'*')
-        return pipeline(agg,result)
+        result = self._reduceColumns(expr,ref,agg)
+        if result is None:
+            result = self._reduceIndex(expr,ref,agg)
+        if result is not None:
+            return result
+        plan = rollup.plan(agg)
+        if plan is not None:
+            return pipeline(plan.rest,self._rollup(expr,ref,plan))
+        ids = self._select(expr)
+        plan = parallel.plan(agg)
+        if plan is not None:
+            pick = self._picker(plan.fields)
+            rows = (pick(node) for id in ids 
+                    for node in self._iterNodes(self.external[id],ref))
+            return pipeline(plan.rest,plan.output(parallel.aggregate(plan,rows)))
+        attrs = projection(agg)
+        stamps = stamped(agg)
+        return pipeline(agg,Parts(self._rows(self.external[id],ref,attrs,stamps)
+                                  for id in ids))
+
+    def REGISTER(self,name,expr,ref,agg):
+        """
+        Keeps the AGGREGATE of expr, ref and agg as the view name, up to
+        date through every write. Views live in memory only.
+        """
+        self.views[name] = View(self,expr,ref,agg)
+        return name
+
+    def VIEW(self,name):
+        if name not in self.views:
+            raise KeyError("View %s does not exist" %name)
+        return self.views[name].read()
+
+    def UNREGISTER(self,name):
+        if self.views.pop(name,None) is None:
+            raise KeyError("View %s does not exist" %name)
+        return name
+
+    def _maintain(self,change,*args):
+        """
+        Passes a write on to the views. A view failing to follow it is
+        left broken and recounted when it is next read.
+        """
+        for view in self.views.itervalues():
+            if view.broken:
+                continue
+            try:
+                getattr(view,change)(*args)
+            except Exception:
+                view.broken = True
+
+    def _rollup(self,expr,ref,plan):
+        """
+        Rows of the nodes ref reaches from the selected nodes, each with
+        the $rollup aggregates of its own descendants. Every subtree is
+        walked once, below its topmost selected node. Nodes without
+        descendants only get their _id, as $reduce gives {} on no rows.
+        """
+        if not set(ref.split(',')) <= set(rollup.ROLLUP_REFERENCES):
+            raise SyntaxError("$rollup accepts %s references only"
+                              %str(rollup.ROLLUP_REFERENCES))
+        ids = self._select(expr)
+        pick = self._picker(plan.fields)
+        totals = {}
+        for h in self._topmost(ids):
+            top = self._node(h)
+            for node, accs in rollup.totals(plan,top,pick):
+                row = plan.output({(): accs} if node['_children'] else {})
+                row['_id'] = node['_id']
+                totals[node['_id']] = row
+        return [dict(totals[node['_id']]) for h in ids 
+                for node in self._iterNodes(self.external[h],ref)]
+
+    def _topmost(self,ids):
+        """Handles among ids without an ancestor among ids."""
+        for h in ids:
+            id = self.external[h]
+            while id != '_ROOT':
+                id = self.parentChildMap[id]
+                if self.handles[id] in ids:
+                    break
+            else:
+                yield h
+
+    def _rows(self,id,ref,attrs,stamps=()):
+        for node in self._iterNodes(id,ref):
+            row = self._project(node,attrs)
+            for k in stamps:
+                if k in row:
+                    row[k] = self._stamp(k,node)
+            yield row
+
+    def _stamp(self,k,node):
+        """Timestamp of attribute k in node in seconds since the epoch,
+        worked out when it was indexed, None if it is not a timestamp."""
+        return self.stamps.get(k,{}).get(self.handles[node['_id']])
+
+    def cached(self,key):
+        """Serialized result stored for key at the current version."""
+        return self.results.get((self.version,)+key)
+
+    def cache(self,key,version,parts):
+        if version != self.version:
+            return
+        if sum([len(p) for p in parts]) > RESULT_CACHE_BYTES:
+            return
+        self.results.put((version,)+key,parts)
+
+    def _mutated(self):
+        self.version += 1
+        self.results.clear()
 			
     def _getNodes(self,id,refs):
         ret = []
@@ -159,140 +321,469 @@ class Tree(dict):
             if ref == 'SELF':
                 ret.append(self.PM[id])
             elif ref == 'CHILDREN':
-                ret.append(self.PM[id]['_children'])
+                ret.extend(self.PM[id]['_children'])
             elif ref == 'DESCENDANTS':
+                i = len(ret)
+                ret.extend([None]*(self.sizes[self.handles[id]]-1))
                 for node in self.PM[id]['_children']:
-                    ret.extend(flattenTree(node))
+                    for desc in traverse(node):
+                        ret[i] = desc
+                        i += 1
             elif ref == 'PARENT':
                 node = self.PM[id]
                 parent = self.parentChildMap[node['_id']]
                 if parent != '_ROOT':
                     ret.append(self.PM[parent])
             elif ref == 'ANCESTORS':
-                while True:
-                    id = self.parentChildMap[self.PM[id]['_id']]
-                    if id == '_ROOT':
-                        break
-                    ret.append(self.PM[id])
-                ret.reverse()
+                i = len(ret) + self.depths[self.handles[id]] - 1
+                ret.extend([None]*(i-len(ret)))
+                ancestor = self.parentChildMap[id]
+                while ancestor != '_ROOT':
+                    i -= 1
+                    ret[i] = self.PM[ancestor]
+                    ancestor = self.parentChildMap[ancestor]
         return ret
            
-    def _getAllID(self,expr,ids):
-        prefix = Selector(expr).toPrefix()
-        if not prefix:
-            return set([self['_id']])
-        if len(prefix) == 1:
-            return self._getIDset(prefix[0],ids)
-        operandStack = []
-        while prefix:
-            pop = prefix.pop()
-            if isinstance(pop, Operator):
-                operand_1 = operandStack.pop()
-                if isinstance(operand_1, tuple):
-                    operand_1 = self._getIDset(operand_1,ids)	
-                operand_2 = operandStack.pop()
-                if isinstance(operand_2, tuple):
-                    operand_2 = self._getIDset(operand_2,ids)						
-                computed = evaluate(operand_1,operand_2,pop)
-                operandStack.append(computed)	
+    def _iterNodes(self,id,refs):
+        """
+        Nodes _getNodes would return, one at a time and with children
+        listed one by one. References of the root resolve to the root
+        itself, its children and the whole tree.
+        """
+        ordRefs = [r for r in REFERENCES if r in refs.split(',')]
+        for ref in ordRefs:
+            if id == '_ROOT':
+                node = self
+            elif id in self.PM:
+                node = self.PM[id]
             else:
-                operandStack.append(pop)			
-        return operandStack[0]
+                continue
+            if ref == 'SELF':
+                yield node
+            elif ref == 'CHILDREN':
+                for child in node['_children']:
+                    yield child
+            elif ref == 'DESCENDANTS':
+                for child in node['_children']:
+                    for desc in traverse(child):
+                        yield desc
+            elif ref in ('PARENT','ANCESTORS') and id != '_ROOT':
+                for ancestor in self._getNodes(id,ref):
+                    yield ancestor
+
+    def _select(self,expr):
+        ids = Bitmap([0])	
+        for node in compileSelector(expr):
+            ids = self._getAllID(node,ids)       		
+        return ids
+
+    def _reduceColumns(self,expr,ref,agg):
+        """
+        Result of a lone $reduce over SELF computed from the numeric
+        columns, None when the request needs the full pipeline.
+        """
+        if not NUMERIC_COLUMNS or ref != 'SELF':
+            return None
+        if not isinstance(agg,list) or len(agg) != 1:
+            return None
+        request = agg[0]
+        if not isinstance(request,dict) or request.keys() != ['$reduce']:
+            return None
+        request = request['$reduce']
+        if not isinstance(request,dict):
+            return None
+        operands = []
+        for okey, req in request.iteritems():
+            if okey.startswith('$') or not isinstance(req,dict) or len(req) != 1:
+                return None
+            operator, operand = req.items()[0]
+            if isinstance(operand,basestring) and operand.startswith('$'):
+                operand = operand[1:]
+            elif operator == '$sum' and operand == 1:
+                operator, operand = '$sum1', None
+            else:
+                return None
+            if operator not in columnar or operand in ('_id','$children'):
+                return None
+            operands.append((okey,operator,operand))
+        ids = self._select(expr)
+        if not ids:
+            return None
+        output = {}
+        for okey, operator, operand in operands:
+            values, floats = Column().gather(ids)
+            if operand is not None:
+                gathered = self._gather(operand,ids)
+                if gathered is None:
+                    return None
+                values, floats = gathered
+            if values and not floats:
+                if max(max(values),-min(values))*len(values) >= EXACT:
+                    return None
+            elif floats and floats != len(values):
+                if operator in ('$minimum','$maximum'):
+                    return None
+            output[okey] = columnar[operator](values,len(ids),not floats)
+        return output
+
+    def _reduceIndex(self,expr,ref,agg):
+        """
+        Result of a lone $reduce of $median and $percentile over SELF,
+        or the DESCENDANTS of the root, picked from the sorted value
+        index or the numeric column. None when the request needs the
+        full pipeline.
+        """
+        refs = set(ref.split(','))
+        if not refs <= set(['SELF','DESCENDANTS']):
+            return None
+        if not isinstance(agg,list) or len(agg) != 1:
+            return None
+        request = agg[0]
+        if not isinstance(request,dict) or request.keys() != ['$reduce']:
+            return None
+        if not isinstance(request['$reduce'],dict):
+            return None
+        try:
+            operands = _operands(request['$reduce'])
+        except (SyntaxError, TypeError, AttributeError):
+            return None
+        for okey, operator, operand in operands:
+            name = operator[0] if isinstance(operator,tuple) else operator
+            if name not in ('$median','$percentile'):
+                return None
+        ids = self._select(expr)
+        if 'DESCENDANTS' in refs and ids != Bitmap([0]):
+            return None
+        if not ids or ids == Bitmap([0]) and refs == set(['SELF']):
+            return None
+        output = {}
+        for okey, operator, operand in operands:
+            nth = self._ranked(operand,ids,refs)
+            if nth is None:
+                return None
+            size = nth.size
+            if not size:
+                output[okey] = None
+            elif operator == '$median':
+                lower = nth((size - 1) // 2)
+                if size % 2:
+                    output[okey] = lower
+                else:
+                    output[okey] = _middle(lower,nth(size // 2))
+            else:
+                p = accumulators[operator]().p
+                output[okey] = nth(_rank(p,size))
+        return output
+
+    def _ranked(self,k,ids,refs):
+        """
+        Function giving the value of rank r, 0 based, among the values
+        other than None of attribute k that refs reach from ids, with
+        their count as its size. None if some of them are objects or
+        values the columns do not keep as numbers.
+        """
+        if k in ('_id','$children') or k.startswith('_ts_'):
+            return None
+        def reach(holders):
+            if 'DESCENDANTS' not in refs:
+                return holders & ids
+            return holders if 'SELF' in refs else holders - ids
+        if reach(self.objects.get(k, Bitmap())):
+            return None
+        index = self.RI.get(k, ValueIndex())
+        nulls = index.get(None, Bitmap())
+        held = reach(index.ids) - nulls
+        column = self.columns.get(k, Column())
+        if len(held - column.valid):
+            return None
+        size = len(held)
+        if size == index.size - len(nulls):
+            nth = lambda r: index.nth(r,None,size)
+        else:
+            values, floats = column.gather(held)
+            if floats and floats != size:
+                nth = lambda r: index.nth(r,held,size)
+            else:
+                values = list(values) if floats else map(int,values)
+                nth = lambda r: _select(values,r)
+        nth.size = size
+        return nth
+
+    def _gather(self,k,ids):
+        """
+        Numbers of attribute k held by ids with the count of floats
+        among them, None if some of ids hold a value that is neither
+        a number nor null.
+        """
+        objects = self.objects.get(k)
+        if objects and objects & ids:
+            return None
+        index = self.RI.get(k)
+        column = self.columns.get(k, Column())
+        if index is not None:
+            others = index.ids & ids
+            others.difference_update(column.valid)
+            nulls = index.get(None)
+            if nulls:
+                others.difference_update(nulls)
+            if others:
+                return None
+        return column.gather(ids)
+
+    def _getAllID(self,node,ids,plan=None):
+        if node is None:
+            if plan is not None:
+                plan.append({'selector':{},'strategy':'root','rows':1})
+            return Bitmap([0])
+        return self._evaluate(node,ids,plan)
+
+    def _evaluate(self,node,caps,plan=None):
+        if isinstance(node,tuple):
+            ids = self._getIDset(node,caps)
+            if plan is not None:
+                plan.append({'selector':dict([node]),'strategy':'index',
+                             'estimate':self._estimate(node),'rows':len(ids)})
+            return ids
+        operator, operands = node
+        if plan is not None:
+            record = {'operator':operator.type,'estimate':self._estimate(node),
+                      'operands':[]}
+            plan.append(record)
+            plan = record['operands']
+        if operator == _or:
+            ids = Bitmap()
+            for operand in operands:
+                ids.update(self._evaluate(operand,caps,plan))
+        else:
+            ranked = sorted([(self._estimate(o),i,o) 
+                             for i,o in enumerate(operands)])
+            ids = None
+            for estimate, i, operand in ranked:
+                if ids is None:
+                    ids = self._evaluate(operand,caps,plan)
+                elif self._isExists(operand):
+                    ids = self._exists(operand,ids)
+                    if plan is not None:
+                        plan.append({'selector':self._selector(operand),
+                                     'strategy':'exists','estimate':estimate,
+                                     'rows':len(ids)})
+                elif (len(ids) * VERIFY_COST < estimate and 
+                      self._verifiable(operand)):
+                    ids = self._verify(operand,ids,caps)
+                    if plan is not None:
+                        plan.append({'selector':self._selector(operand),
+                                     'strategy':'verify','estimate':estimate,
+                                     'rows':len(ids)})
+                else:
+                    ids.intersection_update(self._evaluate(operand,caps,plan))
+                if not ids:
+                    if plan is not None:
+                        plan.extend([{'selector':self._selector(o),
+                                      'strategy':'skipped','estimate':e}
+                                     for e,j,o in ranked if j > i])
+                    break
+        if plan is not None:
+            record['rows'] = len(ids)
+        return ids
+
+    def _estimate(self,node):
+        if not isinstance(node,tuple):
+            operator, operands = node
+            estimates = [self._estimate(o) for o in operands]
+            if operator == _or:
+                return min(sum(estimates),len(self.PM))
+            return min(estimates)
+        attrKey, attrValue = node
+        if attrKey == '_id':
+            if isinstance(attrValue,dict) and attrValue.keys()[0] == '$in':
+                return len(attrValue.values()[0])
+            return 1
+        if attrKey == '$child' or attrKey == '$desc':
+            return len(self.PM)
+        operator, attrValue = self._relation(node)
+        index = self.RI.get(attrKey)
+        if operator == '$exists':
+            size = len(index.ids) if index else 0
+            return size if attrValue else len(self.PM) - size
+        if not index:
+            return 0
+        return index.estimate(attrValue,operator)
+
+    def _verifiable(self,node):
+        if not isinstance(node,tuple):
+            return all([self._verifiable(o) for o in node[1]])
+        return node[0] not in ('$child','$desc') and not node[0].startswith('_ts_')
+
+    def _verify(self,node,candidates,caps):
+        if not isinstance(node,tuple):
+            operator, operands = node
+            if operator == _or:
+                ids = Bitmap()
+                for operand in operands:
+                    ids.update(self._verify(operand,candidates,caps))
+                return ids
+            for operand in operands:
+                candidates = self._verify(operand,candidates,caps)
+                if not candidates:
+                    break
+            return candidates
+        attrKey = node[0]
+        if attrKey == '_id':
+            return candidates & self._getIDset(node,caps)
+        if self._isExists(node):
+            return self._exists(node,candidates)
+        operator, attrValue = self._relation(node)
+        ids = Bitmap()
+        for id in candidates:
+            match = self.PM.get(self.external[id])
+            if match is None:
+                continue
+            if not match.has_key(attrKey) or isinstance(match[attrKey],dict):
+                continue
+            if matchRelation(self._indexKey(attrKey,match[attrKey]),
+                             attrValue,operator):
+                ids.add(id)
+        return self.labels.within(ids,caps)
+
+    def _isExists(self,node):
+        return (isinstance(node,tuple) and isinstance(node[1],dict) and
+                node[1].keys()[0] == '$exists')
+
+    def _exists(self,node,candidates=None):
+        """Ids matching an $exists leaf, among candidates if given."""
+        attrKey, attrValue = node
+        index = self.RI.get(attrKey)
+        present = index.ids if index else Bitmap()
+        if attrValue.values()[0]:
+            if candidates is None:
+                return present.copy()
+            return present & candidates
+        if candidates is None:
+            return self.live - present
+        return (candidates - present) & self.live
+
+    def _selector(self,node):
+        if isinstance(node,tuple):
+            return dict([node])
+        return {node[0].type:[self._selector(o) for o in node[1]]}
+
+    def _relation(self,expr):
+        attrKey, attrValue = expr
+        operator = '$eq'
+        if isinstance(attrValue,dict):
+            operator, attrValue = attrValue.items()[0] 
+        if attrKey.startswith('_ts_') and operator != '$exists':
+            try:
+                attrValue, first = tsparser.parse(attrValue,fuzzy=True)
+            except:
+                raise Exception("Unable to handle timestamp %s" %attrValue)
+        return operator, attrValue
 			
     def _getIDset(self, expr,caps):
         attrKey = expr[0]
         attrValue = expr[1]
-        operator = '$eq'
         if attrKey == '_id':
             if isinstance(attrValue,dict):
                 if attrValue.keys()[0] == '$eq':
-                    return set(attrValue.values())
+                    return self._handleSet(attrValue.values())
                 else:
-                    return set(attrValue.values()[0])  
+                    return self._handleSet(attrValue.values()[0])  
                 
-            return set([attrValue])
+            return self._handleSet([attrValue])
 
         if attrKey == '$child':      
-            childset = set()
+            childset = Bitmap()
             i = 0
-            for _and in attrValue.get('$&',[]):
-                childIDs = self._getAllID(_and,['_ROOT'])
+            for _and in attrValue.compiled.get('$&',[]):
+                childIDs = self._getAllID(_and,Bitmap([0]))
                 if i:
-                    childset.intersection_update(set([self.parentChildMap[id] 
-				                                 for id in childIDs]))
+                    childset.intersection_update(self._parents(childIDs))
                 else:
-                    childset.update(set([self.parentChildMap[id] 
-				                                 for id in childIDs]))        
+                    childset.update(self._parents(childIDs))        
                 i += 1												 
-            for _or in attrValue.get('$|',[]):
-                childIDs = self._getAllID(_or,['_ROOT'])
-                childset.update(set([self.parentChildMap[id] 
-				                for id in childIDs]))
-            return childset - set(['_ROOT'])
+            for _or in attrValue.compiled.get('$|',[]):
+                childIDs = self._getAllID(_or,Bitmap([0]))
+                childset.update(self._parents(childIDs))
+            childset.discard(0)
+            return childset
         if attrKey == '$desc':
-            descset = set()   
-            i = 0
-            for _and in attrValue.get('$&',[]):
-                ids = set()
-                descIDs = self._getAllID(_and,['_ROOT'])
-                for id in descIDs:
-                    fid = self.parentChildMap[id]
-                    while True:
-                        if fid == '_ROOT':
-                            break
-                        ids.add(fid)
-                        fid = self.parentChildMap[fid]
-                if i:
-                    descset.intersection_update(ids)
+            descset = None
+            for _and in attrValue.compiled.get('$&',[]):
+                descIDs = self._getAllID(_and,Bitmap([0]))
+                if descset is None:
+                    descset = self._ancestors(descIDs)
                 else:
-                    descset.update(ids)
-                i += 1
-            for _or in attrValue.get('$|',[]):
-                ids = set()
-                descIDs = self._getAllID(_or,['_ROOT'])
-                for id in descIDs:
-                    fid = self.parentChildMap[id]
-                    while True:
-                        if fid == '_ROOT':
-                            break
-                        ids.add(fid)
-                        fid = self.parentChildMap[fid]
-                descset.update(ids)		
+                    descset = self.labels.stab(descset,descIDs)
+            if descset is None:
+                descset = Bitmap()
+            for _or in attrValue.compiled.get('$|',[]):
+                descIDs = self._getAllID(_or,Bitmap([0]))
+                descset.update(self._ancestors(descIDs))
             return descset
 			
-        if isinstance(attrValue,dict):
-            operator, attrValue = attrValue.items()[0] 
-			
-        if operator == '$exists':
-            if attrValue:
-                return set.union(*self.RI[attrKey].values())
+        if self._isExists(expr):
+            return self._exists(expr)
+        operator, attrValue = self._relation(expr)
+        index = self.RI.get(attrKey)
+        if not index:
+            ids = Bitmap()
+        elif operator in lookup_relational:
+            ids = index.lookup(attrValue,operator)
+        else:
+            if operator in range_relational:
+                matchKeys = index.select(attrValue,operator)
+            elif operator == '$regex':
+                matchKeys = index.regex(attrValue)
             else:
-                return set(self.PM.keys()) - set.union(*self.RI[attrKey].values())
-				
-        if attrKey.startswith('_ts_'):
-            try:
-                attrValue, first = tsparser.parse(attrValue,fuzzy=True)
-            except:
-                raise Exception("Unable to handle timestamp %s" %attrValue)
-                			
-        matchKeys = filterByRelation(self.RI.get(attrKey,dict()).keys(),
-		                             attrValue,operator)
-        ids = set()
-        for matchKey in matchKeys:
-            ids.update(self.RI[attrKey][matchKey])
-        fids = set()
+                matchKeys = filterByRelation(index.keys(),attrValue,operator)
+            ids = Bitmap()
+            ids.update(*[index[matchKey] for matchKey in matchKeys])
+        return self.labels.within(ids,caps)
+               
+    def _ancestors(self,ids):
+        ancestors = set()
         for id in ids:
-            fid = self.parentChildMap[id]
-            while fid not in caps:
+            fid = self.parentChildMap.get(self.external[id])
+            while fid is not None and fid != '_ROOT' and fid not in ancestors:
+                ancestors.add(fid)
                 fid = self.parentChildMap[fid]
-            else:
-                fids.add(id)					
-        return fids
+        return self._handleSet(ancestors)
+
+    def _parents(self,ids):
+        return self._handleSet([self.parentChildMap[self.external[id]] 
+                                for id in ids])
+
+    def _handleSet(self,ids):
+        """Bitmap of the handles of the existing ids among ids."""
+        return Bitmap(sorted([self.handles[id] for id in ids 
+                              if id in self.handles]))
+
+    def _bind(self,id):
+        if self.free:
+            handle = self.free.pop()
+            self.external[handle] = id
+        else:
+            handle = len(self.external)
+            self.external.append(id)
+            self.sizes.append(1)
+            self.depths.append(0)
+        self.handles[id] = handle
+        self.live.add(handle)
+
+    def _unbind(self,id):
+        handle = self.handles.pop(id,None)
+        if handle is None:
+            return
+        self.external[handle] = None
+        self.free.append(handle)
+        self.live.discard(handle)
                
     def _putTree(self,here,tree,num):
         if num > 1:
             tree = deepcopy(tree)
+        tree = toNode(tree,self.strings.intern)
         attrsMap = defaultdict(lambda: defaultdict(set))	
+        order = []
         traverser = traverse(tree)
         try:
             while True:
@@ -302,6 +793,8 @@ class Tree(dict):
                     break
                 parentID = self._setID(node)
                 self.PM[parentID] = node			
+                self._bind(parentID)
+                order.append(parentID)
                 for k,v in node.iteritems():
                     if not isinstance(k, basestring):
                         raise KeyError("All attribute keys should be string")
@@ -309,7 +802,9 @@ class Tree(dict):
                         raise KeyError("attribute cannot start with '$'")
                     if '.' in k:
                         raise KeyError("attribute cannot contain '.'")
-                    if k!='_id' and k!='_children' and not isinstance(v,dict):
+                    if k!='_id' and k!='_children' and isinstance(v,dict):
+                        self._indexObject(k,parentID)
+                    elif k!='_id' and k!='_children':
                         if isinstance(v,list):
                             v = self._handleList(v)
                         attrsMap[k][v].add(parentID) 			
@@ -321,18 +816,45 @@ class Tree(dict):
                     self.parentChildMap[id] = parentID 	
 		    		
             self.parentChildMap[tree['_id']] = here['_id']  				
-            here['_children'].append(tree)
+            here.adopt(tree)
+            self._grow(order)
+            self.labels.insert(here,tree)
   
             for attr,valMap in attrsMap.iteritems():
                 for val, map in valMap.iteritems():	
                     if attr.startswith('_ts_'):
                         val = self._handleTS(attr,val)					
-                    self.RI[attr][val].update(map)		
+                    for id in map:
+                        self._indexValue(attr,val,id)
+            if self.views:
+                self._maintain('inserted',tree)
             return tree['_id']
         except Exception, e:
             self._delTree(tree,here)
             raise Exception(e)
 
+    def _grow(self,order):
+        """
+        Depths and subtree sizes of a new subtree, given its ids in
+        breadth first order, and the sizes of the nodes above it.
+        """
+        handles, parents = self.handles, self.parentChildMap
+        for id in order:
+            h = handles[id]
+            self.sizes[h] = 1
+            self.depths[h] = self.depths[handles[parents[id]]] + 1
+        for id in reversed(order[1:]):
+            self.sizes[handles[parents[id]]] += self.sizes[handles[id]]
+        self._resize(parents[order[0]],self.sizes[handles[order[0]]])
+
+    def _resize(self,id,n):
+        """Adds n to the sizes of id and the nodes above it."""
+        while True:
+            self.sizes[self.handles[id]] += n
+            if id == '_ROOT':
+                return
+            id = self.parentChildMap[id]
+
     def _putAttrs(self, here, attrs):
         oldAttrs = {k:here[k] for k in attrs.keys() if here.has_key(k)}
         try:		        
@@ -345,52 +867,69 @@ class Tree(dict):
                     raise KeyError("attribute cannot contain '.'")
                 if k == '_id' or k == '_children':
                     raise KeyError("attribute cannot be %s " %k)               
-                
                 if oldAttrs.has_key(k):
                     oldVal = oldAttrs[k]
                     if isinstance(oldVal,list) and isinstance(v,dict):
                         self._handleListAttrs(here,k,v)
                         continue
-                    elif k.startswith('_ts_'):
-                        oldVal = self._handleTS(k,oldVal)
-                    elif isinstance(v,list):
-                        oldVal = self._handleList(v)
                     if not isinstance(oldVal,dict):
-                        self.RI[k][oldVal].remove(here['_id'])
-                    if not self.RI[k][oldVal]:
-                        del self.RI[k][oldVal]
-                    if not self.RI[k]:
-                        del self.RI[k]
+                        self._unindexValue(k,self._indexKey(k,oldVal),
+                                           here['_id'])
+                    else:
+                        self._unindexObject(k,here['_id'])
 						
-                here[k] = v	
+                here[k] = v = self.strings.intern(v)
+                if oldAttrs.has_key(k):
+                    self.strings.release(oldAttrs[k])
 				
                 if not isinstance(v,dict):
-                    if k.startswith('_ts_'):
-                        v = self._handleTS(k,v)
-                    if isinstance(v,list):
-                        v = self._handleList(v)
-                    self.RI[k][v].add(here['_id'])
+                    self._indexValue(k,self._indexKey(k,v),here['_id'])
+                else:
+                    self._indexObject(k,here['_id'])
 						
+            if self.views:
+                self._maintain('touched',self.handles[here['_id']],here,
+                               attrs.keys())
         except Exception, e:
-            self._delAttrs(here,attrs.keys(),oldAttrs)
+            self._delAttrs(here,[k for k in attrs.keys() 
+                                 if k != '_id' and k != '_children'],oldAttrs)
             raise Exception(e)
 			
     def _delTree(self, node, parent=None):
         if not parent:
-            parent = self.GET(json.dumps({'_id':node['_id']}),'PARENT')[0]
-        try:
-            index = parent['_children'].index(node)
-        except ValueError:
-            index = -1
+            parentID = self.parentChildMap[node['_id']]
+            parent = self if parentID == '_ROOT' else self.PM[parentID]
+        size = 0
+        if self.PM.get(node['_id']) is node:
+            size = self.sizes[self.handles[node['_id']]]
         flatTree = flattenTree(node)
+        removed = []
         for tree in flatTree:
-		
-            if self.PM.has_key(tree['_id']):
-                del self.PM[tree['_id']]
+            if self.PM.get(tree['_id']) is not tree:
+                continue
+            for k,v in tree.iteritems():
+                if k == '_id' or k == '_children':
+                    continue
+                self.strings.release(v)
+                if isinstance(v,dict):
+                    self._unindexObject(k,tree['_id'])
+                    continue
+                try:
+                    v = self._indexKey(k,v)
+                except:
+                    continue
+                self._unindexValue(k,v,tree['_id'])
+            del self.PM[tree['_id']]
+            if tree['_id'] in self.handles:
+                removed.append(self.handles[tree['_id']])
+            self._unbind(tree['_id'])
+            self.labels.remove(tree['_id'])
             if self.parentChildMap.has_key(tree['_id']):
                 del self.parentChildMap[tree['_id']]
-        if index > -1:           
-            del parent['_children'][index]
+        if parent.disown(node) and size:
+            self._resize(parent['_id'],-size)
+        if self.views:
+            self._maintain('removed',removed)
 						
     def _delAttrs(self,here,attrs='*',replace={}):
         if attrs == '*':
@@ -399,34 +938,74 @@ class Tree(dict):
             if isinstance(k, dict):
                 self._handleListAttrs(here,k.keys()[0],k.values()[0])
                 continue
+            if k == '_id' or k == '_children':
+                raise KeyError("attribute cannot be %s " %k)    
             if here.has_key(k):
                 v = here[k]
                 del here[k]
-                if k == '_id' or k == '_children':
-                    raise KeyError("attribute cannot be %s " %k)    
-                if k.startswith('_ts_'):
-                    v = self._handleTS(k,v)
-                if isinstance(v,list):
-                    v = self._handleList(v)
-                if self.RI.has_key(k):
-                    if self.RI[k].has_key(v):
-                        self.RI[k][v].remove(here['_id'])
-                if self.RI.has_key(k) and self.RI[k].has_key(v):
-                    if not self.RI[k][v]:
-                        del self.RI[k][v]
-                    if not self.RI[k]:
-                        del self.RI[k]
+                self.strings.release(v)
+                if not isinstance(v,dict):
+                    self._unindexValue(k,self._indexKey(k,v),here['_id'])
+                else:
+                    self._unindexObject(k,here['_id'])
 						
             if replace.has_key(k):
-                oldVal = replace[k]
-                if k.startswith('_ts_'):
-                    oldVal = self._handleTS(k,oldVal)                
+                oldVal = self.strings.intern(replace[k])
                 here[k] = oldVal
-                if isinstance(oldVal,list):
-                    oldVal = self._handleList(oldVal)                   
                 if not isinstance(oldVal,dict):
-                    self.RI[k][oldVal].add(here['_id'])	
+                    self._indexValue(k,self._indexKey(k,oldVal),here['_id'])
+                else:
+                    self._indexObject(k,here['_id'])
+        if self.views:
+            self._maintain('touched',self.handles[here['_id']],here,
+                           [k.keys()[0] if isinstance(k,dict) else k 
+                            for k in attrs])
 					
+    def _indexValue(self,k,v,id):
+        self.RI[k].add(v,self.handles[id])
+        if NUMERIC_COLUMNS and numeric(v):
+            if not self.columns.has_key(k):
+                self.columns[k] = Column()
+            self.columns[k].set(self.handles[id],v)
+        elif k.startswith('_ts_') and isinstance(v,basestring):
+            if not self.stamps.has_key(k):
+                self.stamps[k] = {}
+            self.stamps[k][self.handles[id]] = epoch(v)
+
+    def _unindexValue(self,k,v,id):
+        if not self.RI.has_key(k) or not self.handles.has_key(id):
+            return
+        self.RI[k].discard(v,self.handles[id])
+        if not self.RI[k]:
+            del self.RI[k]
+        if self.columns.has_key(k) and numeric(v):
+            column = self.columns[k]
+            column.discard(self.handles[id])
+            if not column.valid:
+                del self.columns[k]
+        elif self.stamps.has_key(k) and isinstance(v,basestring):
+            stamps = self.stamps[k]
+            stamps.pop(self.handles[id],None)
+            if not stamps:
+                del self.stamps[k]
+
+    def _indexObject(self,k,id):
+        self.objects[k].add(self.handles[id])
+
+    def _unindexObject(self,k,id):
+        if not self.objects.has_key(k) or not self.handles.has_key(id):
+            return
+        self.objects[k].discard(self.handles[id])
+        if not self.objects[k]:
+            del self.objects[k]
+
+    def _indexKey(self,k,v):
+        if k.startswith('_ts_'):
+            return self._handleTS(k,v)
+        if isinstance(v,list):
+            return self._handleList(v)
+        return v
+
     def _handleList(self,l):
         return tuple([a for a in l if not isinstance(a,(list,dict))])
 			   
@@ -457,34 +1036,32 @@ class Tree(dict):
     def _handleListAttrs(self,node,k,v):
         operator, value = v.items()[0]
         oldKey = self._handleList(node[k])
+        old = list(node[k])
         l = listFuncs(node[k], operator, value)  
+        node[k] = self.strings.intern(node[k])
+        self.strings.release(old)
         newKey = self._handleList(node[k])     
 	
-        self.RI[k][oldKey].remove(node['_id'])
-        if not self.RI[k][oldKey]:
-            del self.RI[k][oldKey]
-        if not self.RI[k]:
-            del self.RI[k]
-						
-        self.RI[k][newKey].add(node['_id'])       
+        self._unindexValue(k,oldKey,node['_id'])
+        self._indexValue(k,newKey,node['_id'])
 			
     def _resetTS(self,k,first):
         if not self.RI.has_key(k):
             return
-        ids = set.union(*self.RI[k].values()) 	
-        self.RI[k] = defaultdict(set)
+        ids = self.RI[k].ids
+        index = ValueIndex()
         for id in ids:      
-            ts, ret = tsparser.parse(self.PM[id][k],dayfirst=first=='day',
-			                           yearfirst=first=='year',fuzzy=True)
+            ts, ret = tsparser.parse(self.PM[self.external[id]][k],
+                                     dayfirst=first=='day',
+                                     yearfirst=first=='year',fuzzy=True)
             if ret != first:
                 raise Exception
-            if self.RI[k].has_key(ts):
-                self.RI[k][ts].add(id)
-            else:
-                self.RI[k][ts] = set([id])
+            index.add(ts,id)
+            self.stamps[k][id] = epoch(ts)
+        self.RI[k] = index
 		
     def _setID(self,node):
-        if not isinstance(node, dict):
+        if not isinstance(node, Node):
             raise TypeError("Node should be Object Type")
         if node.has_key('_id'):
             id = node['_id']
@@ -497,6 +1074,16 @@ class Tree(dict):
             node['_id'] = id
         return id		
 		
+    def adopt(self,child):
+        self['_children'].append(child)
+
+    def disown(self,child):
+        for i, c in enumerate(self['_children']):
+            if c is child:
+                del self['_children'][i]
+                return True
+        return False
+		
     def dump(self,out):
         breaker = treebreaker(self)
         with open(out,'w') as f:
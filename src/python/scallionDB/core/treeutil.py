@@ -13,13 +13,20 @@
  '''
 
 from scallionDB.parser.constants import *
-from scallionDB.parser.selection import Operator
+from scallionDB.parser.selection import Operator, Selector
 from random import randint
-import json, re
+from cache import LRUCache
+from node import Node, todict
+import json, re, sys
+from collections import deque
+import sre_parse, sre_constants
 
 _and = Operator('$and')
 _or = Operator('$or')
 
+patterns = LRUCache(256)
+selectors = LRUCache(512)
+
 def generateID():
     return "%09x" % randint(0,10**11)
 
@@ -30,6 +37,91 @@ def evaluate(op1,op2,operator):
         return op1 | op2
 				
 
+class PathSelector(dict):
+    """
+    Value of a $child or $desc selector, carrying the compiled form of
+    its $& and $| sub-selectors.
+    """
+    def __init__(self,expr):
+        dict.__init__(self,expr)
+        self.compiled = dict([(k,[compileExpr(e) for e in v]) 
+                              for k,v in expr.iteritems()])
+
+def compileSelector(text):
+    """
+    Operator trees of the selectors in a GET statement, cached by the
+    selector text. None stands for the root selector {}.
+    """
+    compiled = selectors.get(text)
+    if compiled is None:
+        expr = json.loads(text)
+        if isinstance(expr,dict):
+            expr = [expr]
+        compiled = [compileExpr(e) for e in expr]
+        selectors.put(text,compiled)
+    return compiled
+
+def compileExpr(expr):
+    if not Selector(expr).toPrefix():
+        return None
+    return selectorToTree(expr)
+
+def selectorToTree(expr):
+    """
+    Turns a validated selector into nested [operator, operands] lists.
+    Several keys in one object are an implicit $and, and chains of the
+    same operator are merged into one operand list.
+    """
+    operands = []
+    for k,v in expr.iteritems():
+        if k in logical:
+            node = [Operator(k),[selectorToTree(item) for item in v]]
+        elif k in path:
+            node = (k,PathSelector(v))
+        else:
+            node = (k,v)
+        operands.append(node)
+    if len(operands) == 1:
+        return _flatten(operands[0])
+    return _flatten([Operator('$and'),operands])
+
+def _flatten(node):
+    if isinstance(node,tuple):
+        return node
+    operator, operands = node
+    merged = []
+    for operand in operands:
+        if isinstance(operand,list) and operand[0] == operator:
+            merged.extend(operand[1])
+        else:
+            merged.append(operand)
+    return [operator,merged]
+
+def matchRelation(key,value,operator):
+    if operator == '$in':
+        if isinstance(key,tuple):
+            return any([v in key for v in value])
+        return key in value
+    if operator == '$contains':
+        return isinstance(key,tuple) and all([v in key for v in value])
+    if operator == '$eq':
+        return key == value
+    if operator == '$neq':
+        return key != value
+    if operator == '$lt':
+        return key < value
+    if operator == '$gt':
+        return key > value
+    if operator == '$lte':
+        return key <= value
+    if operator == '$gte':
+        return key >= value
+    if operator == '$regex':
+        return (isinstance(key,basestring) and 
+                compileRegex(value)[0].search(key) is not None)
+    raise ValueError("Comparison should be made with one of "
+		             "%s" %str(relational))
+
 def filterByRelation(keys,value,operator):
     if operator not in relational:
         raise ValueError("Comparison should be made with one of "
@@ -64,8 +156,53 @@ def filterByRelation(keys,value,operator):
     if operator == '$gte':
         return set(filter((lambda x: x >= value), keys))	
     if operator == '$regex':
+        search = compileRegex(value)[0].search
         str_keys = [a for a in keys if isinstance(a,basestring)]
-        return set(filter((lambda x: re.search(value,x)), str_keys))	
+        return set(filter(search, str_keys))	
+
+def compileRegex(value):
+    compiled = patterns.get(value)
+    if compiled is None:
+        pattern = re.compile(value)
+        prefix, literals = regexLiterals(value)
+        compiled = (pattern, prefix, literals)
+        patterns.put(value, compiled)
+    return compiled
+
+def regexLiterals(value):
+    """
+    Returns the literal prefix of an anchored pattern (or None) and the
+    literal runs every match has to contain.
+    """
+    parsed = sre_parse.parse(value)
+    flags = parsed.pattern.flags
+    if flags & (sre_constants.SRE_FLAG_IGNORECASE|sre_constants.SRE_FLAG_LOCALE):
+        return None, []
+    runs = []
+    run = []
+    anchored = False
+    for i, (op, av) in enumerate(parsed.data):
+        if op == sre_constants.LITERAL and av <= sys.maxunicode:
+            run.append(unichr(av))
+            continue
+        if run:
+            runs.append(''.join(run))
+            run = []
+        if i == 0 and op == sre_constants.AT:
+            if av == sre_constants.AT_BEGINNING_STRING:
+                anchored = True
+            elif av == sre_constants.AT_BEGINNING:
+                anchored = not flags & sre_constants.SRE_FLAG_MULTILINE
+    if run:
+        runs.append(''.join(run))
+    prefix = None
+    if anchored and len(parsed.data) > 1:
+        if parsed.data[1][0] == sre_constants.LITERAL:
+            prefix = runs[0]
+    return prefix, runs
+
+def trigrams(s):
+    return set([s[i:i+3] for i in xrange(len(s)-2)])
 		
 def flattenTree(tree):
     nodes = []
@@ -81,16 +218,13 @@ def traverse(tree):
     if not tree.has_key('_children'):
         tree['_children'] = []
     yield tree
-    nodeQ = []
-    nodeQ.extend(tree['_children'])
-    i = 0
-    while i < len(nodeQ):
-        node = nodeQ[i]
+    nodeQ = deque(tree['_children'])
+    while nodeQ:
+        node = nodeQ.popleft()
         if not node.has_key('_children'):
             node['_children'] = []
         yield node
         nodeQ.extend(node['_children'])
-        i += 1
 		
 def reduceToNode(node,num):
     if not node:
@@ -105,14 +239,14 @@ def reduceToNode(node,num):
 def treebreaker(tree):	
 	
     childStack = []
-    if not isinstance(tree,dict):
-        yield json.dumps(tree)
+    if not isinstance(tree,(dict,Node)):
+        yield json.dumps(tree,default=todict)
         raise StopIteration        
     if not tree.has_key('_children'):
-        yield json.dumps(tree)
+        yield json.dumps(tree,default=todict)
         raise StopIteration
     if not tree['_children']:
-        yield json.dumps(tree)
+        yield json.dumps(tree,default=todict)
         raise StopIteration
     while True:
         node = reduce(reduceToNode, childStack, tree)
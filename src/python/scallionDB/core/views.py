@@ -0,0 +1,232 @@
+''' 
+  Licensed under the Apache License, Version 2.0 (the "License"); you may
+  not use this file except in compliance with the License. You may obtain
+  a copy of the License at
+ 
+      http://www.apache.org/licenses/LICENSE-2.0
+ 
+  Unless required by applicable law or agreed to in writing, software
+  distributed under the License is distributed on an "AS IS" BASIS,
+  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+  See the License for the specific language governing permissions and
+  limitations under the License.
+ '''
+
+import json
+import threading
+
+from treeutil import traverse
+from aggregation import pipeline, parallel
+from aggregation.apply import accumulators
+
+VIEW_REFERENCES = ['SELF','CHILDREN','DESCENDANTS']
+
+
+class Group(object):
+    __slots__ = ('accs', 'members')
+
+    def __init__(self, accs):
+        self.accs = accs
+        self.members = set()
+
+
+class View(object):
+    """
+    Materialized AGGREGATE of a $reduce, or a $flatten and a $group,
+    over the nodes a selector reaches through SELF, CHILDREN and
+    DESCENDANTS. For every node it counts, the view keeps its row
+    and how many times the references reach it, and it keeps the
+    accumulators of every group. Tree writes adjust both. Removals
+    an accumulator cannot undo exactly leave its group dirty, and
+    the group is rebuilt from its members when the view is read.
+    """
+
+    def __init__(self, tree, expr, ref, agg):
+        self.plan = parallel.plan(agg)
+        if self.plan is None:
+            raise SyntaxError("A view starts with a $reduce, or a $flatten "
+                              "and a $group, of decomposable functions")
+        if '$append' in self.plan.operators:
+            raise SyntaxError("$append depends on row order, it cannot "
+                              "be kept in a view")
+        refs = [r for r in VIEW_REFERENCES if r in ref.split(',')]
+        if not refs or len(refs) != len(set(ref.split(','))):
+            raise SyntaxError("Views accept %s references only" 
+                              %str(VIEW_REFERENCES))
+        self.tree = tree
+        self.expr = expr
+        self.ref = ','.join(refs)
+        self.refs = set(refs)
+        self.keys = set()
+        self.absent = set()
+        self.structural = _selectorKeys(json.loads(expr),self.keys,
+                                        self.absent)
+        self.fields = set(self.plan.fields)
+        self.width = len(self.plan.names)
+        self.pick = tree._picker(self.plan.fields)
+        self.lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        """Recounts the view from the tree."""
+        self.broken = True
+        self.selected = self.tree._select(self.expr)
+        self.rows = {}
+        self.groups = {}
+        self.dirty = set()
+        for s in self.selected:
+            self._reach(s,1)
+        self.broken = False
+
+    def read(self):
+        with self.lock:
+            if self.broken:
+                self.refresh()
+            for key in self.dirty:
+                self._rebuild(key)
+            self.dirty.clear()
+            aggregate = dict([(key, group.accs) 
+                              for key, group in self.groups.iteritems()])
+        return pipeline(self.plan.rest,self.plan.output(aggregate))
+
+    def inserted(self, root):
+        """Counts a new subtree."""
+        tree = self.tree
+        keys = set()
+        parent = tree.handles[tree.parentChildMap[root['_id']]]
+        above = {parent: self._above(parent)}
+        for node in traverse(root):
+            h = tree.handles[node['_id']]
+            up = tree.handles[tree.parentChildMap[node['_id']]]
+            inside = up in self.selected
+            above[h] = above[up] + inside
+            keys.update(node.shape.keys)
+            times = ('CHILDREN' in self.refs and inside) + \
+                ('DESCENDANTS' in self.refs and above[h])
+            if times:
+                self._count(h,node,times)
+        if self.structural or self.absent or '_id' in self.keys or \
+                self.keys & keys:
+            self._reselect()
+
+    def touched(self, h, node, keys):
+        """Recounts a node whose attributes keys were written."""
+        entry = self.rows.get(h)
+        if entry is not None and self.fields.intersection(keys):
+            row = self.pick(node)
+            if row != entry[0]:
+                del self.rows[h]
+                self._apply(entry[0],h,-entry[1])
+                self.rows[h] = [row, entry[1]]
+                self._apply(row,h,entry[1])
+        if self.structural or self.keys.intersection(keys):
+            self._reselect()
+
+    def removed(self, handles):
+        """Drops the nodes of a deleted subtree."""
+        for h in handles:
+            entry = self.rows.pop(h,None)
+            if entry is not None:
+                self._apply(entry[0],h,-entry[1])
+            self.selected.discard(h)
+        if self.structural:
+            self._reselect()
+
+    def _above(self, h):
+        """Times DESCENDANTS reaches the children of h."""
+        if 'DESCENDANTS' not in self.refs:
+            return 0
+        tree = self.tree
+        times = 0
+        id = tree.external[h]
+        while id != '_ROOT':
+            id = tree.parentChildMap[id]
+            times += tree.handles[id] in self.selected
+        return times
+
+    def _reselect(self):
+        selected = self.tree._select(self.expr)
+        for s in selected - self.selected:
+            self._reach(s,1)
+        for s in self.selected - selected:
+            self._reach(s,-1)
+        self.selected = selected
+
+    def _reach(self, s, times):
+        tree = self.tree
+        for node in tree._iterNodes(tree.external[s],self.ref):
+            self._count(tree.handles[node['_id']],node,times)
+
+    def _count(self, h, node, times):
+        entry = self.rows.get(h)
+        if entry is None:
+            entry = self.rows[h] = [self.pick(node), 0]
+        entry[1] += times
+        if entry[1] <= 0:
+            del self.rows[h]
+        self._apply(entry[0],h,times)
+
+    def _apply(self, row, h, times):
+        key = row[:self.width]
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = Group([acc() for acc in 
+                                              self._accumulators()])
+        if h in self.rows:
+            group.members.add(h)
+        else:
+            group.members.discard(h)
+        if not group.members:
+            del self.groups[key]
+            self.dirty.discard(key)
+            return
+        if key in self.dirty:
+            return
+        values = row[self.width:]
+        if times > 0:
+            for acc, value in zip(group.accs,values):
+                for i in xrange(times):
+                    acc.update(value)
+            return
+        for acc, value in zip(group.accs,values):
+            remove = getattr(acc,'remove',None)
+            if remove is None or not all([remove(value) 
+                                          for i in xrange(-times)]):
+                self.dirty.add(key)
+                return
+
+    def _accumulators(self):
+        return [accumulators[op] for op in self.plan.operators]
+
+    def _rebuild(self, key):
+        group = self.groups[key]
+        group.accs = [acc() for acc in self._accumulators()]
+        for h in group.members:
+            row, times = self.rows[h]
+            for acc, value in zip(group.accs,row[self.width:]):
+                for i in xrange(times):
+                    acc.update(value)
+
+
+def _selectorKeys(expr, keys, absent):
+    """
+    Adds the attributes a selector reads to keys, and those it matches
+    nodes lacking to absent. Returns whether its matches also depend on
+    the shape of the tree.
+    """
+    if isinstance(expr,list):
+        for e in expr:
+            _selectorKeys(e,keys,absent)
+        return len(expr) > 1
+    structural = False
+    for k, v in expr.iteritems():
+        if k in ('$and','$or'):
+            for item in v:
+                structural = _selectorKeys(item,keys,absent) or structural
+        elif k in ('$child','$desc'):
+            structural = True
+        else:
+            keys.add(k)
+            if isinstance(v,dict) and '$exists' in v and not v['$exists']:
+                absent.add(k)
+    return structural
@@ -106,11 +106,12 @@ class Daemon:
             sys.stderr.write(message % self.pidfile)
             return # not an error in a restart
 
-        # Try killing the daemon process  
+        # Try killing the daemon process group, its process pool included
         print 'Stopping...'		
         try:
+            group = os.getpgid(pid)
             while 1:
-                os.kill(pid, SIGTERM)
+                os.killpg(group, SIGTERM)
                 time.sleep(0.1)
         except OSError, err:
             err = str(err)
@@ -16,8 +16,11 @@ path_logical = ['$&','$|']
 path = ['$child','$desc']
 relational = ['$eq','$neq','$lte','$gte','$lt','$gt','$regex','$exists',
                '$in', '$contains']
+range_relational = ['$lt','$lte','$gt','$gte']
+lookup_relational = ['$eq','$neq','$in','$contains']
 id_type = ['$eq','$in']
-requests = ['GET','PUT','DELETE','LOAD','SHOW','DESCRIBE','SAVE','AGGREGATE']
+requests = ['GET','PUT','DELETE','LOAD','SHOW','DESCRIBE','SAVE','AGGREGATE',
+            'EXPLAIN','STATS','REGISTER','VIEW','UNREGISTER']
 request_types = {'GETREQ':'GET',
                  'PUTREQ':'PUT',
 				 'DELREQ':'DELETE',
@@ -27,7 +30,7 @@ request_types = {'GETREQ':'GET',
 				 'AGGREQ':'AGGREGATE'}
 tree_requests = ['GET','PUT','DELETE','LOAD','DESCRIBE','SAVE']
 nontree_requests = ['SHOW']
-read_request = ['GET','DESCRIBE']
+read_request = ['GET','DESCRIBE','EXPLAIN','STATS','VIEW']
 resources = ['TREE','ATTR']
 references = ['ANCESTORS','PARENT','SELF','CHILDREN','DESCENDANTS']
 tree_references = ['SELF','PARENT']
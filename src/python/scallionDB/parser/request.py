@@ -19,11 +19,71 @@ import re,json
 
 REGEX = r"((?P<LOAD>(((?P<LOADREQ>LOAD)|(?P<SAVEREQ>SAVE))\s(?(LOADREQ)((?P<LOADTREENAME>[a-zA-Z0-9_]+)\s(?P<FILEPATH>[a-zA-Z0-9_\.\/\-\s:\\]+))|(?P<SAVETREENAME>[a-zA-Z0-9_]+)(?!(.+?)))))|(?P<NONLOAD>((?P<GETREQ>GET)|(?P<AGGREQ>AGGREGATE)|(?P<PUTREQ>PUT)|(?P<DELREQ>DELETE)|(?P<SHOWREQ>SHOW))\s(?(SHOWREQ)(TREES)(?!(.+?))|(?(LOADREQ)(LOADTREE)(?!(.+?))|((?P<ATTR>ATTR)|(?P<TREE>TREE)))\s(?P<TREENAME>[a-zA-Z0-9_]+)\s(?(ATTR)(?P<ATTRREF>((SELF|CHILDREN|DESCENDANTS|ANCESTORS|PARENT)|(((SELF|CHILDREN|DESCENDANTS|ANCESTORS|PARENT)(,*))+)))|(?P<TREEREF>(SELF|PARENT)))\s(?P<SELECTOR>(\{.*\}|\[\{.*\}\]))(?(PUTREQ)(\s(?P<PUTTREE>\{.+\}))|(?(ATTR)((\s(?P<ATTRLIST>\[.+?\]$))|\s(?P<ALLATTRJSON>\*)(?!(.+?)))|(?!(.+?)))))))"
 expr = re.compile(REGEX)
+EXPLAIN = r"EXPLAIN\s(?P<TREENAME>[a-zA-Z0-9_]+)\s(?P<SELECTOR>(\{.*\}|\[\{.*\}\]))$"
+explain = re.compile(EXPLAIN)
+DESCRIBE = r"DESCRIBE\s(?P<TREENAME>[a-zA-Z0-9_]+)\s(?P<SELECTOR>(\{.*\}|\[\{.*\}\]))$"
+describe = re.compile(DESCRIBE)
+STATS = r"STATS\s(?P<TREENAME>[a-zA-Z0-9_]+)$"
+stats = re.compile(STATS)
+REGISTER = r"REGISTER\s(?P<TREENAME>[a-zA-Z0-9_]+)\s(?P<VIEW>[a-zA-Z0-9_]+)\s(?P<REFS>(SELF|CHILDREN|DESCENDANTS)(,(SELF|CHILDREN|DESCENDANTS))*)\s(?P<SELECTOR>(\{.*\}|\[\{.*\}\]))\s(?P<PIPELINE>\[.+\])$"
+register = re.compile(REGISTER)
+VIEW = r"(?P<REQUEST>VIEW|UNREGISTER)\s(?P<TREENAME>[a-zA-Z0-9_]+)\s(?P<VIEW>[a-zA-Z0-9_]+)$"
+view = re.compile(VIEW)
 
 def parse_request(request):
-    groups = expr.finditer(request).next().groupdict()
     parsed = {'type':None, 'request':None, 'attrs':None,'newtree':None,
-              'selector':None, 'tree':None, 'path':None, 'reference':None}
+              'selector':None, 'tree':None, 'path':None, 'reference':None,
+              'view':None}
+    if request.startswith('EXPLAIN'):
+        match = explain.match(request)
+        if not match:
+            raise SyntaxError("Invalid EXPLAIN request")
+        groups = match.groupdict()
+        parsed['request'] = 'EXPLAIN'
+        parsed['type'] = 'read'
+        parsed['tree'] = groups['TREENAME']
+        parsed['selector'] = groups['SELECTOR']
+        return parsed
+    if request.startswith('DESCRIBE'):
+        match = describe.match(request)
+        if not match:
+            raise SyntaxError("Invalid DESCRIBE request")
+        parsed['request'] = 'DESCRIBE'
+        parsed['type'] = 'read'
+        parsed['tree'] = match.group('TREENAME')
+        parsed['selector'] = match.group('SELECTOR')
+        return parsed
+    if request.startswith('STATS'):
+        match = stats.match(request)
+        if not match:
+            raise SyntaxError("Invalid STATS request")
+        parsed['request'] = 'STATS'
+        parsed['type'] = 'read'
+        parsed['tree'] = match.group('TREENAME')
+        return parsed
+    if request.startswith('REGISTER'):
+        match = register.match(request)
+        if not match:
+            raise SyntaxError("Invalid REGISTER request")
+        groups = match.groupdict()
+        parsed['request'] = 'REGISTER'
+        parsed['type'] = 'write'
+        parsed['tree'] = groups['TREENAME']
+        parsed['view'] = groups['VIEW']
+        parsed['reference'] = groups['REFS']
+        parsed['selector'] = groups['SELECTOR']
+        parsed['attrs'] = groups['PIPELINE']
+        return parsed
+    if request.startswith('VIEW') or request.startswith('UNREGISTER'):
+        match = view.match(request)
+        if not match:
+            raise SyntaxError("Invalid %s request" %request.split()[0])
+        parsed['request'] = match.group('REQUEST')
+        parsed['type'] = 'read' if parsed['request'] == 'VIEW' else 'write'
+        parsed['tree'] = match.group('TREENAME')
+        parsed['view'] = match.group('VIEW')
+        return parsed
+    groups = expr.finditer(request).next().groupdict()
 
     for typ, req in request_types.items():
         if groups.get(typ,None):
@@ -27,8 +27,28 @@ from constants import *
 from collections import Counter
 
 from scallionDB.parser import parse_request
-from scallionDB.core import evaluate, treebreaker
+from scallionDB.core import evaluate, resultKey, treebreaker
+from scallionDB.core.tree import RESULT_CACHE_BYTES
+from scallionDB.core.cache import LRUCache
 
+STATEMENT_CACHE_SIZE = 256
+STATEMENT_CACHE_BYTES = 1 << 16
+
+statements = LRUCache(STATEMENT_CACHE_SIZE)
+
+def parseStatement(request):
+    """
+    parse_request through a cache shared by the broker and the workers,
+    so a statement parsed by the broker reaches its worker parsed. The
+    result cache key is computed along with it.
+    """
+    parsed = statements.get(request)
+    if parsed is None:
+        parsed = parse_request(request)
+        parsed['key'] = resultKey(parsed)
+        if len(request) <= STATEMENT_CACHE_BYTES:
+            statements.put(request,parsed)
+    return dict(parsed)
 		
 class BrokerThread(threading.Thread):
 
@@ -157,7 +177,7 @@ class BrokerThread(threading.Thread):
                     frontend.send_multipart(frames)                      
                 else:
                     try:
-                        parsed = parse_request(frames[-1])
+                        parsed = parseStatement(frames[-1])
                         type, tree = parsed['type'], parsed['tree']
                     except:
                         frames[-1] = SDB_FAILURE
@@ -245,44 +265,36 @@ class WorkerThread(threading.Thread):
                 frames = self.worker.recv_multipart()
                 if len(frames) == 3:
                     request = frames[-1]
-                    parsed = parse_request(request)
+                    parsed = parseStatement(request)
                     type, tree = parsed['type'], parsed['tree']
                     frames.insert(2,SDB_MESSAGE)
                     try:
-                        output = evaluate(self.trees,parsed,self.folder)
-                        if isinstance(output, list):
-                            if parsed['request'] == 'GET':
-                                frames[-1] = '['
-                                self.worker.send_multipart(frames)  
-                                get = ''
-                                for out in output:
-                                    breaker = treebreaker(out)
-                                    while True:
-                                        if len(get) > self.chunksize:
-                                            frames[-1] = get
-                                            self.worker.send_multipart(frames)
-                                            get = ''
-                                            time.sleep(0.1)
-                                        try:
-                                            get += breaker.next()		
-                                        except StopIteration:
-                                            break
-                                    frames[-1] = get
-                                    self.worker.send_multipart(frames)
-                                    get = ','	
-                                frames[-1] = ']'
-                                self.worker.send_multipart(frames)        									
-                            else:
-                                output = json.dumps(output)
-                                frames[-1] = output
+                        key = parsed['key']
+                        target = self.trees.get(tree) if key else None
+                        parts = target.cached(key) if target else None
+                        if parts is not None:
+                            for part in parts:
+                                frames[-1] = part
                                 self.worker.send_multipart(frames)
                         else:
-                            frames[-1] = output
-                            self.worker.send_multipart(frames)
+                            version = target.version if target else None
+                            output = evaluate(self.trees,parsed,self.folder)
+                            parts, size = [], 0
+                            for part in self._serialize(parsed['request'],output):
+                                frames[-1] = part
+                                self.worker.send_multipart(frames)
+                                if parts is not None:
+                                    size += len(part)
+                                    parts.append(part)
+                                    if size > RESULT_CACHE_BYTES:
+                                        parts = None
+                            if target and parts is not None:
+                                target.cache(key,version,parts)
+                            del output
                         frames[-2] = SDB_COMPLETE
                         frames[-1] = tree
                         self.worker.send_multipart(frames)
-                        del output
+                        del parts
                         gc.collect()
                         self.commlog.info(request.replace('\n',' '))
                     except:
@@ -313,6 +325,31 @@ class WorkerThread(threading.Thread):
                 heartbeat_at = time.time() + self.BEAT_INTERVAL
                 hb_message = ['','',SDB_HEARTBEAT]
                 self.worker.send_multipart(hb_message)
+
+    def _serialize(self,request,output):
+        if isinstance(output, dict):
+            yield json.dumps(output)
+        elif not isinstance(output, list):
+            yield output
+        elif request != 'GET':
+            yield json.dumps(output)
+        else:
+            yield '['
+            get = ''
+            for out in output:
+                breaker = treebreaker(out)
+                while True:
+                    if len(get) > self.chunksize:
+                        yield get
+                        get = ''
+                        time.sleep(0.1)
+                    try:
+                        get += breaker.next()
+                    except StopIteration:
+                        break
+                yield get
+                get = ','
+            yield ']'
 	
 class SaverThread(threading.Thread):
 
@@ -17,7 +17,9 @@ import sys, os, zmq
 import ConfigParser
 import logging
 import time
+import atexit
 
+from core.aggregation import parallel
 from routing import BrokerThread, WorkerThread, SaverThread, LoaderThread
 from collections import Counter
 
@@ -39,6 +41,8 @@ def start(path):
     folder = config.get('INIT','data_folder')
     if folder.startswith('..'):
         folder = os.path.join(path,'data')
+    if config.has_option('INIT','PROCESSES'):
+        parallel.PROCESSES = int(config.get('INIT','PROCESSES'))
     
     logfolder = os.path.join(path,'logs')
     formatter = logging.Formatter('%(asctime)s %(levelname)-6s %(message)s',
@@ -68,6 +72,9 @@ def start(path):
     consolelog.addHandler(con_handler)
     consolelog.level = 20
     
+    parallel.startPool()
+    atexit.register(parallel.stopPool)
+    
     context = zmq.Context(1)
     trees = {}
     saveCounter = Counter()
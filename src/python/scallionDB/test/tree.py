@@ -13,6 +13,17 @@
  '''
 
 from scallionDB.core.tree import Tree
+from scallionDB.core.bitmap import Bitmap, ARRAY_MAX
+from scallionDB.core.treeutil import regexLiterals, compileSelector, treebreaker
+from scallionDB.core.node import Node, toNode, shapes
+from scallionDB.core.index import ValueIndex, TRIGRAM_THRESHOLD
+from scallionDB.core.resolver import resultKey
+from scallionDB.core.aggregation import pipeline, projection, vectorized, apply
+from scallionDB.core.aggregation import parallel
+from scallionDB.core.aggregation.stream import Parts
+from scallionDB.core.aggregation.operators import applyFunc
+from scallionDB.parser import parse_request
+import itertools
 import json
 import os
 import unittest
@@ -37,3 +48,636 @@ class TreeTest(unittest.TestCase):
         t.DELETE('{"_id":"xxxx"}','ANCESTORS',attrs='*')		
         del j['a'], j['b'], j['_children'][0]['a'],  j['_children'][0]['c']
         self.assertEqual(j,t['_children'][0])	
+
+class AggregateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rows = [{"k":i%3,"v":i,"w":i/2.0 if i%4 else None}
+                     for i in range(20)]
+        self.rows.append({"k":0,"v":"x"})
+        self.rows.append({"k":5,"w":-0.0})
+        self.size, vectorized.VECTOR_ROWS = vectorized.VECTOR_ROWS, 1
+        self.settings = (parallel.PROCESSES, parallel.PARALLEL_ROWS,
+                         parallel.PARTITION_ROWS)
+
+    def tearDown(self):
+        vectorized.VECTOR_ROWS = self.size
+        parallel.stopPool()
+        parallel.PROCESSES, parallel.PARALLEL_ROWS, parallel.PARTITION_ROWS = \
+            self.settings
+
+    def partitioned(self, processes):
+        """Reduces rows in partitions of two, in a pool when processes
+        is more than one."""
+        parallel.stopPool()
+        parallel.PROCESSES = processes
+        parallel.PARALLEL_ROWS = parallel.PARTITION_ROWS = 2
+        parallel.startPool()
+        self.assertEqual(processes > 1,parallel._pool is not None)
+
+    def test_group_backends(self):
+        numpy = vectorized.numpy
+        for agg in [{"s":{"$sum":"$w"},"a":{"$avg":"$w"},"n":{"$sum":1}},
+                    {"m":{"$minimum":"$w"},"x":{"$maximum":"$w"}},
+                    {"n":{"$count":"$v"},"u":{"$unique":"$k"}}]:
+            request = [{"$group":dict(agg,_id={"k":"$k"})}]
+            outputs = []
+            for backend in (numpy,None):
+                vectorized.numpy = backend
+                outputs.append(json.dumps(pipeline(json.loads(json.dumps(request)),
+                                                   self.rows)))
+            vectorized.numpy = numpy
+            self.assertEqual(outputs[0],outputs[1])
+
+    def test_accumulators(self):
+        for values in [[3,None,2.5,-1],[None],[[1,2],[2,3]],[[1]],[[1],None]]:
+            for op, acc in apply.accumulators.items():
+                try:
+                    expected = applyFunc[op](values)
+                except TypeError:
+                    continue
+                running = acc()
+                for v in values:
+                    running.update(v)
+                result = running.result()
+                if op in ('$unique','$union','$intersection') and result:
+                    result, expected = sorted(result), sorted(expected)
+                self.assertEqual((op,expected),(op,result))
+
+    def test_sketches(self):
+        distinct = apply.accumulators['$approxDistinct']
+        quantile = apply.accumulators[('$approxQuantile',0.9)]
+        self.assertTrue(quantile is apply.accumulators[('$approxQuantile',0.9)])
+        sketches = [(distinct(),quantile()) for i in range(3)]
+        values = [i*7919 % 10007 for i in range(20000)]
+        for i, v in enumerate(values):
+            for sketch in sketches[i%3]:
+                sketch.update(v)
+        merged = sketches[0]
+        for d, q in sketches[1:]:
+            merged[0].combine(d)
+            merged[1].combine(q)
+        self.assertTrue(abs(merged[0].result()-10007) < 300)
+        rank = sorted(values).index(merged[1].result())/20000.0
+        self.assertTrue(abs(rank-0.9) < 0.02)
+        self.assertTrue(merged[1].size < 3*apply.KLL_SIZE)
+        rows = [{"k":i%2,"v":i} for i in range(10)] + [{"k":0,"v":None}]
+        request = [{"$group":{"_id":{"k":"$k"},"d":{"$approxDistinct":"$v"},
+                              "m":{"$approxQuantile":"$v"},
+                              "p":{"$approxQuantile":["$v",1]}}},
+                   {"$sort":[{"k":1}]}]
+        self.assertEqual([{"k":0,"d":5,"m":4,"p":8},{"k":1,"d":5,"m":5,"p":9}],
+                         pipeline(request,rows))
+        self.assertRaises(SyntaxError,pipeline,[{"$reduce":{"p":
+                          {"$approxQuantile":["$v","x"]}}}],rows)
+        tree = Tree('sketches')
+        tree.LOAD(fn)
+        request = [{"$reduce":{"d":{"$approxDistinct":"$a"},
+                               "p":{"$approxQuantile":["$a",0.25]}}}]
+        outputs = []
+        for processes in (1,2):
+            self.partitioned(processes)
+            outputs.append(tree.AGGREGATE('{}','DESCENDANTS',request))
+        self.assertEqual(outputs[0],outputs[1])
+
+    def test_selection(self):
+        values = [i*7919 % 10007 for i in range(5000)]
+        for k in (0,10,2500,4990,4999):
+            self.assertEqual(sorted(values)[k],apply._select(values,k))
+        self.assertEqual(2.5,applyFunc['$median']([4,1,None,2,3]))
+        self.assertEqual(7,applyFunc['$percentile'](range(1,11),70))
+        self.assertEqual(1,applyFunc['$percentile'](range(1,11),0))
+        self.assertRaises(SyntaxError,pipeline,[{"$reduce":{"p":
+                          {"$percentile":["$v",101]}}}],[{"v":1}])
+        tree = Tree('selection')
+        tree.LOAD(fn)
+        request = [{"$reduce":{"m":{"$median":"$a"},
+                               "p":{"$percentile":["$a",90]}}}]
+        for expr, ref in [('{"a":{"$gt":-10}}','SELF'),('{}','DESCENDANTS'),
+                          ('{}','SELF,DESCENDANTS')]:
+            indexed = tree._reduceIndex(expr,ref,request)
+            self.assertTrue(indexed is not None)
+            ids = tree._select(expr)
+            rows = [{"a":node.get('a')} for id in ids
+                    for node in tree._iterNodes(tree.external[id],ref)]
+            self.assertEqual(pipeline(request,rows),indexed)
+        self.partitioned(2)
+        request = [{"$flatten":True},{"$group":{"_id":{"a":"$a"},
+                    "p":{"$percentile":["$a",90]}}}]
+        self.assertEqual(sorted(pipeline(request,rows)),
+                         sorted(tree.AGGREGATE('{}',ref,request)))
+
+    def test_bucket(self):
+        tree = Tree('bucket')
+        tree.LOAD(fn)
+        tree.PUT('{"_id":"aaaa"}','SELF',{"_id":"tttt","_children":[
+                 {"_id":"t1","_ts_at":"2024-03-10 13:45:10","v":1},
+                 {"_id":"t2","_ts_at":"2024-03-11T01:05:00+02:00","v":2},
+                 {"_id":"t3","_ts_at":"2024-05-01 00:00:00","v":4},
+                 {"_id":"t4","v":8}]})
+        self.assertEqual(1710078310,tree.stamps['_ts_at'][tree.handles['t1']])
+        request = [{"$flatten":True},{"$bucket":{"_ts_at":None}},
+                   {"$group":{"_id":{"_ts_at":"$_ts_at"},"v":{"$sum":"$v"}}},
+                   {"$sort":[{"_ts_at":1}]}]
+        for step, buckets in [('hour',['2024-03-10T13:00:00','2024-03-10T23:00:00',
+                                       '2024-05-01T00:00:00']),
+                              ('week',['2024-03-04T00:00:00','2024-04-29T00:00:00']),
+                              ({"months":3},['2024-01-01T00:00:00',
+                                             '2024-04-01T00:00:00'])]:
+            request[1]['$bucket']['_ts_at'] = step
+            output = tree.AGGREGATE('{"_id":"tttt"}','DESCENDANTS',request)
+            self.assertEqual([None]+buckets,[row['_ts_at'] for row in output])
+            self.assertEqual(15,sum([row['v'] for row in output]))
+        days = [{"$flatten":True},{"$bucket":{"_ts_at":"day"}}]
+        expected = tree.AGGREGATE('{"_id":"tttt"}','DESCENDANTS',days)
+        stamped = [row for row in expected if '_ts_at' in row]
+        for stage, rows in [({"$match":{"_ts_at":{"$exists":True}}},stamped),
+                            ({"$sort":[{"_ts_at":-1}]},expected)]:
+            output = tree.AGGREGATE('{"_id":"tttt"}','DESCENDANTS',
+                                    days[:1]+[stage]+days[1:])
+            self.assertEqual(sorted(rows),sorted(output))
+        self.assertEqual([{"_ts_at":"2024-03-09T00:00:00"}],pipeline(days[1:],
+                         [{"_ts_at":"2024-03-10T01:05:00+02:00"}]))
+        self.assertRaises(ValueError,pipeline,days[1:],[{"_ts_at":"March 10"}])
+        for step in ('fortnight',{"months":1,"days":1},{"days":0}):
+            self.assertRaises(SyntaxError,pipeline,[{"$bucket":{"t":step}}],
+                              [{"t":0}])
+
+    def test_combine(self):
+        values = [3,None,2,[1,2],[2,3],-1,[4]]
+        for op, acc in apply.accumulators.items():
+            for cut in range(len(values)+1):
+                whole, first, second = acc(), acc(), acc()
+                try:
+                    for v in values[:cut]:
+                        whole.update(v)
+                        first.update(v)
+                    for v in values[cut:]:
+                        whole.update(v)
+                        second.update(v)
+                except TypeError:
+                    continue
+                first.combine(second)
+                expected, result = whole.result(), first.result()
+                if isinstance(result,list):
+                    expected, result = sorted(expected), sorted(result)
+                self.assertEqual((op,cut,expected),(op,cut,result))
+
+    def test_partitions(self):
+        tree = Tree('partitions')
+        tree.LOAD(fn)
+        request = [{"$flatten":True},
+                   {"$group":{"_id":{"b":"$b"},"n":{"$sum":1},
+                              "a":{"$sum":"$a"},"m":{"$minimum":"$a"}}},
+                   {"$sort":[{"b":1}]}]
+        outputs = []
+        for processes in (1,2):
+            self.partitioned(processes)
+            outputs.append(tree.AGGREGATE('{}','DESCENDANTS',
+                                          json.loads(json.dumps(request))))
+        self.assertEqual(outputs[0],outputs[1])
+        plan, parallel.plan = parallel.plan, lambda request: None
+        try:
+            expected = tree.AGGREGATE('{}','DESCENDANTS',request)
+        finally:
+            parallel.plan = plan
+        self.assertEqual(expected,outputs[0])
+        self.assertEqual(None,parallel.plan(request[1:]))
+
+    def test_streaming(self):
+        rows = ({"i":i,"l":[i,-i]} for i in itertools.count())
+        request = [{"$match":{"i":{"$gte":10}}},{"$unwind":["l"]},
+                   {"$limit":3}]
+        self.assertEqual([{"i":10,"l":10},{"i":10,"l":-10},{"i":11,"l":11}],
+                         pipeline(request,rows))
+        parts = Parts(iter([r] for r in self.rows[:3]))
+        self.assertEqual([{"n":1}]*3,
+                         pipeline([{"$refreduce":{"n":{"$sum":1}}}],parts))
+        request = [{"$group":{"_id":{"k":"$k"},"n":{"$sum":1}}}]
+        grouped = pipeline(request,[self.rows[:2],self.rows[2:]])
+        self.assertEqual([2,4],[len(g) for g in grouped])
+        self.assertTrue("_id" in request[0]["$group"])
+
+    def test_sort(self):
+        rows = [{"k":i%3,"v":i} for i in range(10)] + [{"v":-1}]
+        request = [{"$sort":[{"k":-1},{"v":1}]},{"$limit":4}]
+        self.assertEqual([2,5,8,1],[r["v"] for r in pipeline(request,rows)])
+        self.assertEqual([-1,0,3,6],[r["v"] for r in 
+                                     pipeline([{"$sort":[{"k":1}]},{"$limit":4}],rows)])
+        ordered = pipeline([{"$sort":[{"k":1},{"v":-1}]}],rows)
+        self.assertEqual([-1,9,6,3,0,7],[r["v"] for r in ordered[:6]])
+        self.assertFalse("k" in rows[-1])
+
+    def test_match(self):
+        match = lambda m: [r.get("v") for r in pipeline([{"$match":m}],
+                                                         self.rows)]
+        self.assertEqual([0,12],match({"k":0,"w":None,"v":{"$lt":15}}))
+        self.assertEqual(["x"],match({"w":{"$exists":False}}))
+        self.assertEqual([18,19,"x"],match({"$or":[{"v":{"$gt":17}},
+                                                  {"v":{"$regex":"x"}}]}))
+        self.assertRaises(SyntaxError,match,{"v":{"$near":1}})
+
+    def test_projection(self):
+        request = [{"$match":{"$or":[{"a":1},{"b":{"$gt":2}}]}},
+                   {"$unwind":["l"]},{"$sort":[{"c":1}]},
+                   {"$group":{"_id":{"g":"$g"},"n":{"$sum":1},
+                              "s":{"$sum":"$$children"}}},
+                   {"$reduce":{"x":{"$sum":"$y"}}}]
+        self.assertEqual(["$children","a","b","c","g","l"],projection(request))
+        self.assertEqual(["k","v"],projection([{"$group":{"_id":{"k":"$v"},
+                                                          "n":{"$sum":1}}}]))
+        self.assertEqual("*",projection(request[:3]))
+        self.assertEqual("*",projection([{"$group":{"n":{"$sum":1}}}]))
+        tree = Tree('projection')
+        tree.LOAD(fn)
+        request = [{"$reduce":{"n":{"$count":"$$children"},"a":{"$sum":"$a"}}}]
+        self.assertEqual({"n":11,"a":4},
+                         tree.AGGREGATE('{}','DESCENDANTS',request))
+
+    def test_aggregate_refs(self):
+        tree = Tree('refs')
+        tree.LOAD(fn)
+        rows = tree.AGGREGATE('{}','DESCENDANTS',[{"$flatten":True}])
+        self.assertEqual(sorted(tree.PM),sorted([r["_id"] for r in rows]))
+        for ref in ('CHILDREN','ANCESTORS,SELF'):
+            self.assertEqual(tree.GET('{"_id":"cccc"}',ref,'*'),
+                             tree.AGGREGATE('{"_id":"cccc"}',ref,[]))
+
+
+class BitmapTest(unittest.TestCase):
+
+    def test_containers(self):
+        a = Bitmap(range(0,3*ARRAY_MAX,2) + [70000,1 << 20])
+        b = Bitmap(range(0,3*ARRAY_MAX,3) + [70000])
+        self.assertFalse(isinstance(a.containers[0],type(b.containers[1])))
+        self.assertEqual(set(a) & set(b),set(a & b))
+        self.assertEqual(set(a) | set(b),set(a | b))
+        self.assertEqual(set(a) - set(b),set(a - b))
+        self.assertEqual(len(set(a) | set(b)),len(a | b))
+        a.update(b,Bitmap([5]))
+        self.assertTrue(5 in a and 6 in a and 7 not in a)
+        for v in list(a):
+            a.discard(v)
+        self.assertEqual(0,len(a))
+        self.assertEqual({},a.containers)
+
+class IndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.t = Tree('index')
+        self.t.LOAD(fn)
+
+    def ids(self,expr):
+        return sorted([n['_id'] for n in self.t.GET(json.dumps(expr),'SELF')])
+
+    def test_range(self):
+        self.assertEqual(['gggg','hhhh'],self.ids({"a":{"$lt":0}}))
+        self.assertEqual(['aaaa','gggg','hhhh'],self.ids({"a":{"$lte":1}}))
+        self.assertEqual(['bbbb','cccc'],self.ids({"a":{"$gt":1}}))
+        self.assertEqual(['cccc'],self.ids({"a":{"$gte":45}}))
+        self.assertEqual(['jjjj'],self.ids({"bar":{"$gt":"c"}}))
+
+    def test_sorted_keys_maintained(self):
+        self.t.PUT('{"_id":"cccc"}','SELF',attrs={"a":100})
+        self.t.DELETE('{"_id":"gggg"}','SELF')
+        self.t.DELETE('{"_id":"bbbb"}','SELF',attrs=["a"])
+        for index in self.t.RI.values():
+            self.assertEqual(sorted(index.keys()),index.ordered)
+        self.assertEqual([1,100],self.t.RI['a'].ordered)
+        self.assertEqual(['cccc'],self.ids({"a":{"$gt":1}}))
+        self.assertFalse('hhhh' in self.t.handles)
+        self.assertEqual(self.t.RI['bar'].ids,self.t.RI['bar'].lookup(None,'$neq'))
+
+    def test_lookup(self):
+        self.t.PUT('{"_id":"dddd"}','SELF',attrs={"bar":["a","z"]})
+        self.assertEqual(['cccc'],self.ids({"bar":"a"}))
+        self.assertEqual(['dddd','eeee','hhhh','jjjj'],
+                         self.ids({"bar":{"$neq":"a"}}))
+        self.assertEqual(['cccc','dddd','hhhh'],
+                         self.ids({"bar":{"$in":["a","c"]}}))
+        self.assertEqual(['dddd'],self.ids({"bar":{"$contains":["z"]}}))
+        self.assertEqual([],self.ids({"nope":{"$in":["a"]}}))
+
+    def test_list_postings(self):
+        self.t.PUT('{"_id":"dddd"}','SELF',attrs={"tags":["x","y"]})
+        self.t.PUT('{"_id":"ffff"}','SELF',attrs={"tags":["y"]})
+        self.assertEqual(['dddd','ffff'],self.ids({"tags":{"$in":["y"]}}))
+        self.assertEqual(['dddd'],self.ids({"tags":{"$contains":["x","y"]}}))
+        self.t.PUT('{"_id":"ffff"}','SELF',attrs={"tags":{"$append":"x"}})
+        self.t.PUT('{"_id":"dddd"}','SELF',attrs={"tags":{"$remove":"y"}})
+        self.assertEqual(['ffff'],self.ids({"tags":{"$contains":["x","y"]}}))
+        self.assertEqual(['dddd','ffff'],self.ids({"tags":{"$in":["x"]}}))
+        self.t.DELETE('{"_id":"ffff"}','SELF')
+        self.assertEqual(['dddd'],self.ids({"tags":{"$in":["x","y"]}}))
+        self.assertEqual(set(['x']),set(self.t.RI['tags'].elements.keys()))
+
+    def test_regex(self):
+        patterns = ["^ba", "^baz$", "all", "a.l", "ar|al", "(?i)BA", "r$"]
+        expected = [self.ids({"foo":{"$regex":p}}) for p in patterns]
+        self.assertEqual(['dddd','ffff','iiii','kkkk'],expected[0])
+        self.assertEqual(['kkkk'],expected[2])
+        self.t.RI['foo'].indexTrigrams()
+        self.t.PUT('{"_id":"cccc"}','SELF',attrs={"foo":"tall"})
+        self.assertEqual(['cccc','kkkk'],self.ids({"foo":{"$regex":"all"}}))
+        self.t.DELETE('{"_id":"cccc"}','SELF',attrs=["foo"])
+        self.assertEqual(expected,
+                         [self.ids({"foo":{"$regex":p}}) for p in patterns])
+        index = ValueIndex()
+        for i in range(TRIGRAM_THRESHOLD):
+            self.assertTrue(index.trigrams is None)
+            index.add('k%05d' %i,i)
+        self.assertEqual(['k00012'],index.regex('00012'))
+
+    def test_regex_literals(self):
+        self.assertEqual((u'foo',[u'foo',u'bar']),regexLiterals(u'^foo.*bar'))
+        self.assertEqual((None,[u'foo']),regexLiterals(u'(?m)^foo'))
+        self.assertEqual((None,[]),regexLiterals(u'foo|bar'))
+        self.assertEqual((None,[]),regexLiterals(u'(?i)foo'))
+
+    def test_caps_and_desc(self):
+        self.assertEqual(['dddd','iiii'],self.ids([{"a":{"$gt":-10}},{"foo":"bar"}]))
+        self.assertEqual(['iiii'],self.ids([{"r":0},{"foo":"bar"}]))
+        self.assertEqual(['aaaa','bbbb','gggg'],
+                         self.ids({"$desc":{"$&":[{"foo":"bar"},{"bar":{"$in":["b","c"]}}]}}))
+        self.assertEqual(['aaaa','bbbb','cccc','gggg','hhhh'],
+                         self.ids({"$desc":{"$|":[{"foo":"bar"}]}}))
+
+    def test_labels(self):
+        def under(id,cap):
+            while id != '_ROOT':
+                id = self.t.parentChildMap[id]
+                if id == cap:
+                    return True
+            return False
+        for i in range(40):
+            self.t.PUT('{"_id":"dddd"}','SELF',{"_id":"d%d" %i,"_children":[{}]})
+            self.t.PUT('{"_id":"d%d"}' %i,'SELF',{"deep":i})
+        self.t.DELETE('{"_id":"d7"}','SELF')
+        ids = self.t.PM.keys()
+        for id in ids:
+            for cap in ids:
+                within = self.t.labels.within([self.t.handles[id]],
+                                              [self.t.handles[cap]])
+                self.assertEqual(under(id,cap),len(within) == 1)
+        self.assertEqual(set(ids),set(self.t.labels.keys()))
+
+    def test_labels_append(self):
+        relabels = []
+        relabel = self.t.labels._relabel
+        self.t.labels._relabel = lambda node: relabels.append(relabel(node))
+        for i in range(3000):
+            self.t.PUT('{"_id":"dddd"}','SELF',{"_id":"p%d" %i})
+        self.assertTrue(len(relabels) < 20)
+        dddd = [self.t.handles['dddd']]
+        for id in ('p0','p1500','p2999'):
+            self.assertEqual(1,len(self.t.labels.within([self.t.handles[id]],dddd)))
+        self.assertEqual(0,len(self.t.labels.within([self.t.handles['aaaa']],dddd)))
+        labels = [self.t.labels[c['_id']] for c in self.t.PM['dddd']['_children']]
+        self.assertEqual(sorted(labels),labels)
+
+    def test_planner(self):
+        self.assertEqual(['cccc'],self.ids({"a":45,"foo":{"$exists":False}}))
+        self.assertEqual(['dddd','hhhh','iiii'],
+                         self.ids({"$or":[{"x":-1},{"foo":"bar","b":{"$exists":False}}],
+                                   "_id":{"$in":["hhhh","iiii","dddd"]},
+                                   "$and":[{"f":{"$exists":False}},{"y":{"$exists":False}}]}))
+        self.assertEqual(['dddd'],self.ids([{"a":{"$gt":30}},
+                                            {"foo":"bar","_id":"dddd"}]))
+        self.assertEqual(['cccc','dddd'],
+                         self.ids({"$or":[{"$or":[{"_id":"cccc"},{"_id":"zzzz"}]},
+                                          {"_id":"dddd"}]}))
+        plan = self.t.EXPLAIN('{"a":45,"foo":{"$exists":false}}')[0]
+        self.assertEqual('$and',plan['operator'])
+        self.assertEqual(['index','exists'],
+                         [o['strategy'] for o in plan['operands']])
+        self.assertEqual(1,plan['rows'])
+        plan = self.t.EXPLAIN('{"a":45,"_id":{"$in":["aaaa","bbbb","cccc","dddd","eeee"]}}')[0]
+        self.assertEqual(['index','verify'],
+                         [o['strategy'] for o in plan['operands']])
+        plan = self.t.EXPLAIN('{"a":1000,"bar":"a"}')[0]
+        self.assertEqual([({"a":1000},'index'),({"bar":"a"},'skipped')],
+                         [(o['selector'],o['strategy']) for o in plan['operands']])
+
+    def test_exists(self):
+        self.assertEqual(['aaaa','cccc','eeee'],self.ids({"b":{"$exists":True}}))
+        self.assertEqual([],self.ids({"nothere":{"$exists":True}}))
+        self.assertEqual(11,len(self.ids({"nothere":{"$exists":False}})))
+        self.t.PUT('{"_id":"dddd"}','SELF',attrs={"b":[1,2]})
+        self.t.DELETE('{"_id":"aaaa"}','SELF',attrs=["b"])
+        self.assertEqual(set(['cccc','dddd','eeee']),
+                         set([self.t.external[h] for h in self.t.RI['b'].ids]))
+        self.assertEqual(['dddd'],self.ids({"b":{"$exists":True},
+                                            "_id":{"$in":["aaaa","dddd","zzzz"]}}))
+        self.assertEqual(['aaaa'],self.ids({"b":{"$exists":False},
+                                            "_id":{"$in":["aaaa","dddd","zzzz"]}}))
+
+    def test_handles(self):
+        handle = self.t.handles['gggg']
+        size = len(self.t.external)
+        self.t.DELETE('{"_id":"gggg"}','SELF')
+        self.assertFalse(handle in self.t.live)
+        self.assertEqual(None,self.t.external[handle])
+        self.t.PUT('{"_id":"aaaa"}','SELF',{"_id":"zzzz","a":7007})
+        self.assertEqual(size,len(self.t.external))
+        self.assertEqual('zzzz',self.t.external[self.t.handles['zzzz']])
+        self.assertEqual(['zzzz'],self.ids({"a":7007}))
+
+    def test_result_cache(self):
+        parsed = parse_request('GET ATTR index CHILDREN,SELF {"b":1,"a":2} *')
+        key = resultKey(parsed)
+        self.assertEqual(key,resultKey(parse_request(
+                         'GET ATTR index SELF,CHILDREN {"a":2,"b":1} *')))
+        version = self.t.version
+        self.t.cache(key,version,['[',']'])
+        self.assertEqual(['[',']'],self.t.cached(key))
+        self.t.PUT('{"_id":"dddd"}','SELF',attrs={"z":1})
+        self.assertEqual(None,self.t.cached(key))
+        self.t.cache(key,version,['[',']'])
+        self.assertEqual(None,self.t.cached(key))
+        self.assertEqual(1,self.t.results.stats()['hits'])
+
+    def test_compiled_selectors(self):
+        text = '{"$child":{"$&":[{"a":{"$gt":30}}]},"x":{"$exists":false}}'
+        compiled = compileSelector(text)
+        self.assertTrue(compiled is compileSelector(text))
+        self.assertEqual([None],compileSelector('{}'))
+        self.assertRaises(SyntaxError,compileSelector,'{"_id":3}')
+        self.assertEqual(['bbbb'],[n['_id'] for n in self.t.GET(text,'SELF')])
+
+    def test_nodes(self):
+        node = self.t.PM['dddd']
+        self.assertTrue(isinstance(node,Node))
+        self.assertTrue(node.shape is self.t.PM['ffff'].shape)
+        self.t.PUT('{"_id":"dddd"}','SELF',{"_id":"w1","only_w1":1})
+        self.assertTrue(('only_w1',) in shapes)
+        self.t.DELETE('{"_id":"w1"}','SELF')
+        self.assertFalse(('only_w1',) in shapes)
+        self.t.PUT('{"_id":"dddd"}','SELF',attrs={"y":2})
+        self.t.DELETE('{"_id":"dddd"}','SELF',attrs=["foo"])
+        self.assertEqual(2,node['y'])
+        self.assertFalse(node.has_key('foo'))
+        self.assertEqual([],node['_children'])
+        self.t.PUT('{"_id":"dddd"}','SELF',{"_id":"b1"})
+        self.assertEqual(['b1'],[c['_id'] for c in node['_children']])
+        out = ''.join(treebreaker(self.t.GET('{"_id":"aaaa"}','SELF')[0]))
+        self.assertEqual(toNode(json.loads(out)),self.t.PM['aaaa'])
+        self.t.DELETE('{"_id":"b1"}','SELF')
+        self.assertEqual(None,node.children)
+
+    def test_interning(self):
+        for id in ('s1','s2','s3'):
+            self.t.PUT('{"_id":"dddd"}','SELF',
+                       json.loads('{"_id":"%s","k":"same"}' %id))
+        saved = self.t.strings.stats()['saved']
+        self.t.PUT('{"_id":"s1"}','SELF',attrs=json.loads('{"l":["same"]}'))
+        self.assertTrue(self.t.PM['s2']['k'] is self.t.PM['s3']['k'])
+        self.assertTrue(self.t.PM['s1']['l'][0] is self.t.PM['s2']['k'])
+        self.assertTrue(self.t.strings.stats()['saved'] > saved)
+        self.assertEqual(['s1','s2','s3'],self.ids({"k":"same"}))
+        self.assertTrue('same' in self.t.strings.strings)
+        self.t.DELETE('{"_id":"s1"}','SELF',attrs=["l"])
+        self.t.PUT('{"_id":"s2"}','SELF',attrs={"k":"other"})
+        self.t.DELETE('{"_id":"s3"}','SELF')
+        self.assertFalse('same' in self.t.strings.strings)
+        self.assertFalse('other' in self.t.strings.strings)
+
+    def test_interning_counts(self):
+        strings = self.t.strings
+        def held():
+            counts = {}
+            def walk(v):
+                if isinstance(v,basestring):
+                    if strings.strings.get(v) is v:
+                        counts[v] = counts.get(v,0) + 1
+                elif isinstance(v,list):
+                    for e in v:
+                        walk(e)
+                elif isinstance(v,dict):
+                    for k,e in v.iteritems():
+                        walk(k)
+                        walk(e)
+            for node in self.t.PM.values():
+                for k,v in node.iteritems():
+                    if k != '_id' and k != '_children':
+                        walk(v)
+            return counts
+        for id in ('n1','n2'):
+            self.t.PUT('{"_id":"dddd"}','SELF',
+                       json.loads('{"_id":"%s","l":["zz","zz"]}' %id))
+        for op in ('$append','$push','$append','$add'):
+            self.t.PUT('{"_id":"n1"}','SELF',attrs=json.loads('{"l":{"%s":"zz"}}' %op))
+        self.assertFalse('$push' in strings.strings)
+        self.assertEqual(held(),strings.counts)
+        self.t.DELETE('{"_id":"n1"}','SELF',attrs=json.loads('[{"l":{"$remove":"zz"}}]'))
+        self.assertEqual(held(),strings.counts)
+        self.t.DELETE('{"_id":"n1"}','SELF')
+        self.assertEqual(held(),strings.counts)
+        self.assertEqual(2,strings.counts['zz'])
+        self.t.DELETE('{"_id":"n2"}','SELF')
+        self.assertFalse('zz' in strings.strings)
+
+    def test_columns(self):
+        agg = [{"$reduce":{"s":{"$sum":"$a"},"m":{"$maximum":"$a"},
+                           "n":{"$sum":1},"v":{"$avg1":"$a"}}}]
+        result = self.t._reduceColumns('{"a":{"$gt":0}}','SELF',agg)
+        self.assertEqual({"s":53,"m":45,"n":3,"v":53/3.0},result)
+        self.assertTrue(isinstance(result["s"],int))
+        self.assertEqual(result,self.t.AGGREGATE('{"a":{"$gt":0}}','SELF',agg))
+        self.t.PUT('{"_id":"dddd"}','SELF',attrs={"a":{"x":1}})
+        both = '{"_id":{"$in":["aaaa","dddd"]}}'
+        self.assertEqual(None,self.t._reduceColumns(both,'SELF',agg))
+        self.t.PUT('{"_id":"dddd"}','SELF',attrs={"a":0.5})
+        agg = [{"$reduce":{"s":{"$sum":"$a"}}}]
+        self.assertEqual({"s":1.5},self.t._reduceColumns(both,'SELF',agg))
+        self.t.DELETE('{"_id":"dddd"}','SELF',attrs=["a"])
+        self.assertEqual([],list(self.t.columns["a"].floats))
+
+    def test_views(self):
+        group = [{"$flatten":True},
+                 {"$group":{"_id":{"foo":"$foo"},"n":{"$sum1":"$a"},
+                            "s":{"$sum":"$a"},"m":{"$maximum":"$a"}}},
+                 {"$sort":[{"foo":1}]}]
+        views = {'g':('{}','DESCENDANTS',group),
+                 'r':('{"a":{"$gt":0}}','SELF,CHILDREN',
+                      [{"$reduce":{"n":{"$sum":1},"a":{"$avg":"$a"}}}]),
+                 'p':('{"$child":{"$&":[{"foo":"bar"}]}}','CHILDREN',
+                      [{"$reduce":{"u":{"$lenunique":"$foo"}}}]),
+                 'e':('{"a":{"$exists":false}}','SELF',
+                      [{"$reduce":{"n":{"$sum":1},"s":{"$sum":"$b"}}}])}
+        for name, (expr, ref, agg) in views.items():
+            self.assertEqual(name,self.t.REGISTER(name,expr,ref,
+                                                  json.loads(json.dumps(agg))))
+        def check():
+            for name, (expr, ref, agg) in views.items():
+                self.assertFalse(self.t.views[name].broken)
+                self.assertEqual(self.t.AGGREGATE(expr,ref,
+                                                  json.loads(json.dumps(agg))),
+                                 self.t.VIEW(name))
+        check()
+        self.t.PUT('{"_id":"cccc"}','SELF',attrs={"a":2,"foo":"bar"})
+        check()
+        self.t.PUT('{"_id":"dddd"}','SELF',{"_id":"v1","a":5,"foo":"bar",
+                                             "_children":[{"a":0.5}]})
+        check()
+        self.t.PUT('{"_id":"dddd"}','SELF',{"_id":"v2","b":7})
+        check()
+        self.t.DELETE('{"_id":"aaaa"}','SELF',attrs=["a"])
+        self.t.DELETE('{"_id":"v1"}','SELF')
+        check()
+        self.t.DELETE('{"_id":"bbbb"}','SELF')
+        check()
+        self.assertRaises(SyntaxError,self.t.REGISTER,'x','{}','DESCENDANTS',
+                          [{"$reduce":{"l":{"$append":"$l"}}}])
+        self.assertRaises(SyntaxError,self.t.REGISTER,'x','{}','PARENT',
+                          views['r'][2])
+        self.assertEqual('g',self.t.UNREGISTER('g'))
+        self.assertRaises(KeyError,self.t.VIEW,'g')
+        parsed = parse_request('REGISTER index r SELF,CHILDREN {"a":1} '
+                               '[{"$reduce":{"n":{"$sum":1}}}]')
+        self.assertEqual(('write','r','SELF,CHILDREN'),
+                         (parsed['type'],parsed['view'],parsed['reference']))
+        self.assertEqual('read',parse_request('VIEW index r')['type'])
+        self.assertEqual('write',parse_request('UNREGISTER index r')['type'])
+
+    def test_rollup(self):
+        reduce = {"n":{"$sum":1},"s":{"$sum":"$a"},"u":{"$union":"$bar"}}
+        rows = self.t.AGGREGATE('{"_id":"aaaa"}','SELF,DESCENDANTS',
+                                [{"$rollup":reduce},{"$sort":[{"_id":1}]}])
+        self.assertEqual(sorted(['aaaa']+[n['_id'] for n in 
+                                          self.t.GET('{"_id":"aaaa"}','DESCENDANTS')]),
+                         [r['_id'] for r in rows])
+        for row in rows:
+            expected = self.t.AGGREGATE(json.dumps({"_id":row['_id']}),
+                                        'DESCENDANTS',[{"$reduce":reduce}])
+            expected['_id'] = row['_id']
+            self.assertEqual(expected,row)
+        self.assertEqual(rows[:1],self.t.AGGREGATE('{"_id":"aaaa"}','SELF',
+                                                   [{"$rollup":reduce}]))
+        self.assertRaises(SyntaxError,self.t.AGGREGATE,'{}','PARENT',
+                          [{"$rollup":reduce}])
+        self.assertRaises(SyntaxError,self.t.AGGREGATE,'{}','SELF',
+                          [{"$rollup":{"l":{"$append":"$l"}}}])
+        self.assertRaises(SyntaxError,self.t.AGGREGATE,'{}','SELF',
+                          [{"$limit":1},{"$rollup":reduce}])
+
+    def test_describe(self):
+        def size(id):
+            return len(self.t.GET(json.dumps({"_id":id}),'SELF,DESCENDANTS'))
+        described = self.t.DESCRIBE('{"_id":{"$in":["aaaa","cccc"]}}')
+        self.assertEqual([(size('aaaa'),1),(size('cccc'),3)],
+                         [(d['size'],d['depth']) for d in described])
+        self.t.PUT('{"_id":"cccc"}','SELF',{"_id":"c1","_children":[{}]})
+        self.assertEqual({"_id":"c1","size":2,"depth":4,"children":1},
+                         self.t.DESCRIBE('{"_id":"c1"}')[0])
+        self.assertEqual(size('aaaa'),self.t.DESCRIBE('{"_id":"aaaa"}')[0]['size'])
+        cccc = self.t.PM['cccc']
+        stale = toNode({"_id":"c2"})
+        cccc['_children'].append(stale)
+        self.t._delTree(stale,cccc)
+        self.assertFalse('c2' in [c['_id'] for c in cccc['_children']])
+        self.assertEqual(size('cccc'),self.t.DESCRIBE('{"_id":"cccc"}')[0]['size'])
+        self.t.DELETE('{"_id":"bbbb"}','SELF')
+        self.t.DELETE('{"_id":"aaaa"}','SELF')
+        root = self.t.DESCRIBE('{}')[0]
+        self.assertEqual((len(self.t.PM)+1,0),(root['size'],root['depth']))
+        self.assertEqual('DESCRIBE',parse_request('DESCRIBE index {}')['request'])